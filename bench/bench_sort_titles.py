@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of the sort phase of a recipe
+
+Runs Recipe._modify_sort_titles_and_cleanup over synthetic lists and
+library maps of growing size, with Plex.set_sort_titles stubbed out.
+Time per item should stay flat as the map grows.
+
+    python bench/bench_sort_titles.py [max_items]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.path.pardir, 'plexlibrary'))
+
+import plexutils  # noqa: E402
+from recipe import IdMap, Recipe  # noqa: E402
+
+
+class StubPlex(object):
+    def set_sort_titles(self, library_key, updates, library_type,
+                        title_format, visible=False):
+        return len(updates)
+
+
+class StubSection(object):
+    key = 1
+
+
+def make_recipe(count):
+    recipe = Recipe.__new__(Recipe)
+    recipe.library_type = 'movie'
+    recipe.plex = StubPlex()
+    recipe.recipe = {
+        'new_library': {
+            'name': 'Benchmark',
+            'sort': True,
+            'sort_title': {
+                'absolute': True,
+                'format': '{number}. {title}',
+                'visible': False,
+            },
+            'remove_from_library': False,
+        },
+    }
+    recipe.dest_map = IdMap(cache_file=os.devnull)
+    for i in range(count):
+        recipe.dest_map.add_record(plexutils.PlexItem.from_dict({
+            'ratingKey': i,
+            'type': 'movie',
+            'title': 'Movie {}'.format(i),
+            'year': 2000 + i % 20,
+            'titleSort': None,
+            'originallyAvailableAt': None,
+            'locations': ['/movies/Movie {}/movie.mkv'.format(i)],
+        }, None), [
+            'imdb://tt{:07d}'.format(i),
+            'tmdb://{}'.format(i),
+        ])
+    item_list = [{
+        'id': 'tt{:07d}'.format(i),
+        'tmdb_id': str(i),
+        'title': 'Movie {}'.format(i),
+        'year': 2000 + i % 20,
+    } for i in reversed(range(count))]
+    return recipe, item_list
+
+
+def bench(count):
+    recipe, item_list = make_recipe(count)
+    start = time.perf_counter()
+    recipe._modify_sort_titles_and_cleanup(item_list, StubSection(),
+                                           sort_only=True)
+    return time.perf_counter() - start
+
+
+def main():
+    max_items = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    count = max_items // 8
+    while count <= max_items:
+        elapsed = bench(count)
+        print(u"{:>7} items: {:.3f}s, {:.2f}us per item".format(
+            count, elapsed, elapsed / count * 1e6))
+        count *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import atexit
+import collections
+import dbm
+import errno
+import shelve
+import threading
+import time
+
+import logs
+
+
+class ShelveCache(object):
+    """Persistent cache with expiring entries
+
+    The shelve file is opened once and kept open for the whole run, with
+    an in-memory LRU of the most recently used entries in front of it.
+    Entries that can't be read are removed one by one instead of
+    clearing the whole file. If another process holds the file, the
+    cache only lives in memory for this run.
+    """
+    def __init__(self, filename, ttl=3600 * 24, lru_size=1024):
+        self.filename = filename
+        self.ttl = ttl
+        self.lru_size = lru_size
+        self._lru = collections.OrderedDict()
+        self._shelf = None
+        self._in_memory = False
+        self._lock = threading.RLock()
+        atexit.register(self.close)
+
+    def _open(self):
+        """Returns the shelf, None if the cache is in memory only"""
+        if self._shelf is not None or self._in_memory:
+            return self._shelf
+        try:
+            self._shelf = shelve.open(self.filename)
+        except dbm.error as e:
+            code = getattr(e, 'errno', None) or (e.args or [None])[0]
+            if code in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                # Locked by another run, leave the file alone
+                logs.warning(u"Cache {} is in use, not using it for this "
+                             u"run ({})".format(self.filename, e))
+                self._in_memory = True
+                return None
+            logs.warning(u"Unable to open cache {}, recreating ({})".format(
+                self.filename, e))
+            try:
+                self._shelf = shelve.open(self.filename, 'n')
+            except dbm.error as e:
+                logs.warning(u"Unable to recreate cache {}, not using it "
+                             u"for this run ({})".format(self.filename, e))
+                self._in_memory = True
+        return self._shelf
+
+    def _remember(self, key, entry):
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, key, ttl=None):
+        """Returns the cached value, raises KeyError if there is no
+        entry or it is older than ttl seconds
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is None:
+                shelf = self._open()
+                if shelf is None:
+                    raise KeyError(key)
+                try:
+                    entry = shelf[key]
+                except KeyError:
+                    raise
+                except Exception as e:
+                    # Unpickling errors, truncated entries etc.
+                    logs.warning(u"Removing unreadable cache entry "
+                                 u"{} ({})".format(key, e))
+                    del shelf[key]
+                    raise KeyError(key)
+                if not isinstance(entry, dict) or 'cached' not in entry \
+                        or 'value' not in entry:
+                    # Old or unknown format
+                    del shelf[key]
+                    raise KeyError(key)
+            if entry.get('ttl') is not None:
+                ttl = min(ttl, entry['ttl'])
+            if entry['cached'] + ttl <= int(time.time()):
+                self._lru.pop(key, None)
+                raise KeyError(key)
+            self._remember(key, entry)
+            return entry['value']
+
+    def set(self, key, value, ttl=None):
+        """Stores value, ttl overrides the ttl given to get() if shorter"""
+        entry = {
+            'cached': int(time.time()),
+            'value': value,
+            'ttl': ttl,
+        }
+        with self._lock:
+            shelf = self._open()
+            if shelf is not None:
+                shelf[key] = entry
+            self._remember(key, entry)
+
+    def lookup(self, namespace, id_, ttl=None):
+        """Returns (hit, value) for id_ under namespace, e.g. an API
+        endpoint
+        """
+        try:
+            return True, self.get('{}:{}'.format(namespace, id_), ttl=ttl)
+        except KeyError:
+            return False, None
+
+    def store(self, namespace, id_, value, not_found_ttl=None):
+        """Stores value for id_ under namespace, None values (not found)
+        expire after not_found_ttl
+        """
+        self.set('{}:{}'.format(namespace, id_), value,
+                 ttl=not_found_ttl if value is None else None)
+
+    def close(self):
+        with self._lock:
+            if self._shelf is not None:
+                self._shelf.close()
+                self._shelf = None
+            self._lru.clear()
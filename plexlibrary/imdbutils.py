@@ -5,7 +5,7 @@ import requests
 from lxml import html
 
 import logs
-from utils import add_years
+from utils import ItemIds, add_years
 
 
 class IMDb(object):
@@ -33,19 +33,22 @@ class IMDb(object):
     def add_movies(self, url, movie_list=None, movie_ids=None, max_age=0):
         if not movie_list:
             movie_list = []
-        if not movie_ids:
-            movie_ids = []
+        if movie_ids is None:
+            movie_ids = ItemIds(movie_list)
         max_date = add_years(max_age * -1)
         logs.info(u"Retrieving the IMDB list: {}".format(url))
 
         (imdb_ids, imdb_titles, imdb_years) = self._handle_request(url)
+        tmdb_results = {}
+        if self.tmdb:
+            tmdb_results = self.tmdb.get_tmdb_from_imdb_many(
+                [i for i in imdb_ids if {'id': i} not in movie_ids], 'movie')
         for i, imdb_id in enumerate(imdb_ids):
             # Skip already added movies
-            if imdb_id in movie_ids:
+            if {'id': imdb_id} in movie_ids:
                 continue
 
-            if self.tmdb:
-                tmdb_data = self.tmdb.get_tmdb_from_imdb(imdb_id, 'movie')
+            tmdb_data = tmdb_results.get(imdb_id)
 
             if tmdb_data and tmdb_data['release_date']:
                 date = datetime.datetime.strptime(tmdb_data['release_date'],
@@ -59,39 +62,45 @@ class IMDb(object):
             # Skip old movies
             if max_age != 0 and (max_date > date):
                 continue
-            movie_list.append({
+            movie = {
                 'id': imdb_id,
                 'tmdb_id': tmdb_data['id'] if tmdb_data else None,
                 'title': tmdb_data['title'] if tmdb_data else imdb_titles[i],
                 'year': date.year,
-            })
-            movie_ids.append(imdb_id)
-            if tmdb_data and tmdb_data['id']:
-                movie_ids.append('tmdb' + str(tmdb_data['id']))
+            }
+            # Listed under a different IMDb id
+            if movie in movie_ids:
+                continue
+            movie_list.append(movie)
+            movie_ids.add(movie)
 
         return movie_list, movie_ids
 
     def add_shows(self, url, show_list=None, show_ids=None, max_age=0):
         if not show_list:
             show_list = []
-        if not show_ids:
-            show_ids = []
+        if show_ids is None:
+            show_ids = ItemIds(show_list)
         curyear = datetime.datetime.now().year
         logs.info(u"Retrieving the IMDb list: {}".format(url))
         data = {}
         if max_age != 0:
             data['extended'] = 'full'
         (imdb_ids, imdb_titles, imdb_years) = self._handle_request(url)
+        tmdb_results = {}
+        if self.tmdb:
+            tmdb_results = self.tmdb.get_tmdb_from_imdb_many(
+                [i for i in imdb_ids if {'id': i} not in show_ids], 'tv')
         for i, imdb_id in enumerate(imdb_ids):
             # Skip already added shows
-            if imdb_id in show_ids:
+            if {'id': imdb_id} in show_ids:
                 continue
 
+            tvdb_data = None
             if self.tvdb:
                 tvdb_data = self.tvdb.get_tvdb_from_imdb(imdb_id)
 
-            if self.tmdb:
-                tmdb_data = self.tmdb.get_tmdb_from_imdb(imdb_id, 'tv')
+            tmdb_data = tmdb_results.get(imdb_id)
 
             if tvdb_data and tvdb_data['firstAired'] != "":
                 year = datetime.datetime.strptime(tvdb_data['firstAired'],
@@ -114,18 +123,18 @@ class IMDb(object):
             else:
                 title = tmdb_data['name'] if tmdb_data else imdb_titles[i]
 
-            show_list.append({
+            show = {
                 'id': imdb_id,
                 'tvdb_id': tvdb_data['id'] if tvdb_data else None,
                 'tmdb_id': tmdb_data['id'] if tmdb_data else None,
                 'title': title,
                 'year': year,
-            })
-            show_ids.append(imdb_id)
-            if tmdb_data and tmdb_data['id']:
-                show_ids.append('tmdb' + str(tmdb_data['id']))
-            if tvdb_data and tvdb_data['id']:
-                show_ids.append('tvdb' + str(tvdb_data['id']))
+            }
+            # Listed under a different IMDb id
+            if show in show_ids:
+                continue
+            show_list.append(show)
+            show_ids.add(show)
 
         return show_list, show_ids
 
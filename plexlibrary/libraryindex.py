@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import logs
+import plexutils
+
+
+class LibraryIndex(object):
+    """Persistent index of all the items of a library section
+
+    Holds a compact PlexItem and the external guids of every item, saved
+    to index_dir/<server>-<section>.json. When the section changed since
+    the index was saved, only the items updated since then are fetched
+    again and the items no longer in the section are dropped.
+    """
+    version = 2
+
+    def __init__(self, section, index_dir, page_size=500):
+        self.section = section
+        self.index_dir = index_dir
+        self.page_size = page_size
+        self.index_file = os.path.join(index_dir, '{}-{}.json'.format(
+            section._server.machineIdentifier, section.key))
+        self._items = {}
+
+    def _load(self):
+        if not os.path.isfile(self.index_file):
+            return None
+        with open(self.index_file, 'r') as f:
+            try:
+                data = json.load(f)
+            except ValueError as e:
+                logs.warning(u"Unable to read the library index, "
+                             u"rebuilding ({})".format(e))
+                return None
+        if data.get('version') != self.version:
+            return None
+        return data
+
+    def _save(self, updated_at):
+        os.makedirs(self.index_dir, exist_ok=True)
+        data = {
+            'version': self.version,
+            'updatedAt': updated_at,
+            'items': {
+                str(key): {'item': record.to_dict(), 'guids': guids}
+                for key, (record, guids) in self._items.items()
+            },
+        }
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, self.index_file)
+
+    def _get_section_state(self):
+        """Returns when the section was last updated and its item count"""
+        updated_at = self.section.updatedAt
+        updated_at = int(updated_at.timestamp()) if updated_at else 0
+        headers = {
+            'X-Plex-Container-Start': '0',
+            'X-Plex-Container-Size': '0',
+        }
+        data = self.section._server.query(
+            '/library/sections/{}/all'.format(self.section.key),
+            headers=headers)
+        total_size = int(data.attrib.get('totalSize') or
+                         data.attrib.get('size') or 0)
+        return updated_at, total_size
+
+    def _get_rating_keys(self):
+        """The ratingKeys of all the items in the section, read from the
+        raw listing without building plexapi objects
+        """
+        key = '/library/sections/{}/all'.format(self.section.key)
+        rating_keys = set()
+        start = 0
+        while True:
+            headers = {
+                'X-Plex-Container-Start': str(start),
+                'X-Plex-Container-Size': str(self.page_size),
+            }
+            data = self.section._server.query(key, headers=headers)
+            page = [elem.attrib.get('ratingKey') for elem in data]
+            rating_keys.update(page)
+            total_size = int(data.attrib.get('totalSize') or 0)
+            start += len(page)
+            if not page or (total_size and start >= total_size):
+                break
+        return rating_keys
+
+    def _fetch(self, filters=''):
+        for item in plexutils.iter_section_items(
+                self.section, page_size=self.page_size, filters=filters):
+            self._items[str(item.ratingKey)] = (
+                plexutils.PlexItem(item), plexutils.get_item_guids(item))
+
+    def refresh(self):
+        updated_at, total_size = self._get_section_state()
+        data = self._load()
+        server = self.section._server
+        if data:
+            self._items = {
+                key: (plexutils.PlexItem.from_dict(entry['item'], server),
+                      entry['guids'])
+                for key, entry in data['items'].items()
+            }
+            if data['updatedAt'] == updated_at \
+                    and len(self._items) == total_size:
+                return
+            logs.info(u"Updating the '{}' library index".format(
+                self.section.title))
+            self._fetch('updatedAt>>={}'.format(data['updatedAt']))
+            if len(self._items) != total_size:
+                # Items were deleted, drop them
+                rating_keys = self._get_rating_keys()
+                for key in set(self._items) - rating_keys:
+                    del self._items[key]
+            if len(self._items) == total_size:
+                self._save(updated_at)
+                return
+        logs.info(u"Building the '{}' library index".format(
+            self.section.title))
+        self._items = {}
+        self._fetch()
+        self._save(updated_at)
+
+    def entries(self):
+        """Yield (PlexItem, guids) for all items"""
+        return self._items.values()
@@ -16,10 +16,13 @@ Credit:
 """
 
 import argparse
+import concurrent.futures
 import sys
 
+import logs
 import recipes
-from recipe import Recipe
+from config import ConfigParser
+from recipe import Recipe, SharedClients
 
 
 def list_recipes(directory=None):
@@ -28,15 +31,60 @@ def list_recipes(directory=None):
         print("    {}".format(name))
 
 
+def run_recipes(recipe_names, jobs=1, use_playlists=False, **kwargs):
+    """Run several recipes sharing one set of clients and source maps
+
+    Recipes that create the same library or playlist run one after
+    another, the others up to jobs at a time.
+    """
+    shared = SharedClients(ConfigParser())
+    groups = {}
+    failed = []
+    for recipe_name in recipe_names:
+        try:
+            r = Recipe(recipe_name=recipe_name, use_playlists=use_playlists,
+                       shared=shared)
+        except Exception as e:
+            logs.error(u"Recipe '{}' failed: {}".format(recipe_name, e))
+            failed.append(recipe_name)
+            continue
+        groups.setdefault(r.target, []).append(r)
+
+    def run_group(group):
+        failed = []
+        for r in group:
+            try:
+                r.run(**kwargs)
+            except Exception as e:
+                logs.error(u"Recipe '{}' failed: {}".format(r.recipe_name, e))
+                failed.append(r.recipe_name)
+        return failed
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for group_failed in executor.map(run_group, groups.values()):
+            failed.extend(group_failed)
+    shared.guid_cache.flush()
+    return failed
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "must be at least 1, got {}".format(value))
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog='plexlibrary',
         description=("This utility creates or maintains a Plex library "
                      "based on a configuration recipe."),
-        usage='%(prog)s [options] [<recipe>]',
+        usage='%(prog)s [options] [<recipe> ...]',
     )
-    parser.add_argument('recipe', nargs='?',
-                        help='Create a library using this recipe')
+    parser.add_argument('recipe', nargs='*',
+                        help='Create a library using this recipe '
+                             '(or several)')
     parser.add_argument(
         '-l', '--list-recipes', action='store_true',
         help='list available recipes')
@@ -48,6 +96,17 @@ def main():
     parser.add_argument(
         '-e', '--everyone', action='store_true', help='share playlist with all users (overrides settings in recipe)'
     )
+    parser.add_argument(
+        '-a', '--all', action='store_true', help='run all recipes'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=positive_int, default=1,
+        help='number of recipes to run in parallel (default: 1)'
+    )
+    parser.add_argument(
+        '--symlink-plan', metavar='FILE',
+        help='dry run, write the symlinks that would be created to FILE'
+    )
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -58,13 +117,31 @@ def main():
         list_recipes()
         sys.exit(0)
 
-    if args.recipe not in recipes.get_recipes():
-        print("Error: No such recipe")
-        list_recipes()
+    recipe_names = recipes.get_recipes() if args.all else args.recipe
+    for recipe_name in recipe_names:
+        if recipe_name not in recipes.get_recipes():
+            print("Error: No such recipe: {}".format(recipe_name))
+            list_recipes()
+            sys.exit(1)
+    if not recipe_names:
+        print("Error: No recipe given")
         sys.exit(1)
 
-    r = Recipe(recipe_name=args.recipe, use_playlists=args.playlists)
-    r.run(sort_only=args.sort_only, share_playlist_to_all=args.everyone)
+    if len(recipe_names) == 1:
+        r = Recipe(recipe_name=recipe_names[0], use_playlists=args.playlists)
+        r.run(sort_only=args.sort_only, share_playlist_to_all=args.everyone,
+              symlink_plan_file=args.symlink_plan)
+    else:
+        if args.symlink_plan:
+            print("Error: --symlink-plan needs a single recipe")
+            sys.exit(1)
+        failed = run_recipes(recipe_names, jobs=args.jobs,
+                             use_playlists=args.playlists,
+                             sort_only=args.sort_only,
+                             share_playlist_to_all=args.everyone)
+        if failed:
+            print("Failed recipes: {}".format(', '.join(failed)))
+            sys.exit(1)
 
     print("Done!")
 
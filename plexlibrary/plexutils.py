@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+import bisect
+import concurrent.futures
+import datetime
+import threading
+import plexapi.exceptions
 import plexapi.server
 import plexapi.media
 import requests
@@ -8,10 +13,273 @@ from typing import List
 import logs
 
 
+class PlexItem(object):
+    """Compact record of a Plex movie or show
+
+    Holds only what is needed for matching, sorting and symlinking.
+    Use fetch() to get the full plexapi object back when needed.
+    """
+    __slots__ = ('ratingKey', 'type', 'title', 'year', 'titleSort',
+                 'originallyAvailableAt', 'locations', '_server')
+
+    def __init__(self, item=None):
+        if item is None:
+            return
+        # Read the XML the item was built from, plexapi reloads partial
+        # items when a missing or lazily parsed attribute is accessed
+        data = item._data
+        self.ratingKey = int(data.attrib['ratingKey'])
+        self.type = data.attrib.get('type')
+        self.title = data.attrib.get('title')
+        year = data.attrib.get('year')
+        self.year = int(year) if year else None
+        self.titleSort = data.attrib.get('titleSort', self.title)
+        date = data.attrib.get('originallyAvailableAt')
+        self.originallyAvailableAt = \
+            datetime.datetime.fromisoformat(date) if date else None
+        # Not every listing includes the show folders, get_locations()
+        # fetches them if needed
+        self.locations = get_data_locations(data)
+        self._server = item._server
+
+    def __repr__(self):
+        return '<{}:{}:{}>'.format(self.__class__.__name__, self.ratingKey,
+                                   self.title)
+
+    def fetch(self):
+        return self._server.fetchItem(int(self.ratingKey))
+
+    def get_locations(self):
+        if not self.locations:
+            self.locations = tuple(self.fetch().locations)
+        return self.locations
+
+    def to_dict(self):
+        date = self.originallyAvailableAt
+        return {
+            'ratingKey': self.ratingKey,
+            'type': self.type,
+            'title': self.title,
+            'year': self.year,
+            'titleSort': self.titleSort,
+            'originallyAvailableAt': date.isoformat() if date else None,
+            'locations': list(self.locations),
+        }
+
+    @classmethod
+    def from_dict(cls, data, server):
+        record = cls()
+        for k in ('ratingKey', 'type', 'title', 'year', 'titleSort'):
+            setattr(record, k, data[k])
+        date = data['originallyAvailableAt']
+        record.originallyAvailableAt = \
+            datetime.datetime.fromisoformat(date) if date else None
+        record.locations = tuple(data['locations'])
+        record._server = server
+        return record
+
+
+def get_data_locations(data):
+    """Part files of a movie or folders of a show, from its XML element"""
+    if data.attrib.get('type') == 'movie':
+        return tuple(part.attrib['file'] for part in data.iter('Part')
+                     if part.attrib.get('file'))
+    return tuple(location.attrib['path']
+                 for location in data.iter('Location')
+                 if location.attrib.get('path'))
+
+
+def fetch_locations(items, chunk_size=100):
+    """Fill in the locations of the PlexItems that have none, fetching
+    chunk_size items per request
+    """
+    missing = {}
+    for item in items:
+        if not item.locations:
+            missing.setdefault(item._server, {})[str(item.ratingKey)] = item
+    for server, by_key in missing.items():
+        rating_keys = list(by_key)
+        for i in range(0, len(rating_keys), chunk_size):
+            data = server.query('/library/metadata/{}'.format(
+                ','.join(rating_keys[i:i + chunk_size])))
+            for elem in data:
+                item = by_key.get(elem.attrib.get('ratingKey'))
+                if item is not None:
+                    item.locations = get_data_locations(elem)
+
+
+def iter_section_items(section, page_size=500, filters=''):
+    """Yield all items in a library section, including external guids,
+    fetching page_size items per request so that only one page is held
+    in memory at a time
+    :param filters: extra query string, e.g. 'updatedAt>>=1600000000'
+    """
+    key = '/library/sections/{}/all?includeGuids=1'.format(section.key)
+    if filters:
+        key += '&' + filters
+    start = 0
+    while True:
+        headers = {
+            'X-Plex-Container-Start': str(start),
+            'X-Plex-Container-Size': str(page_size),
+        }
+        data = section._server.query(key, headers=headers)
+        page = section.findItems(data, initpath=key)
+        section_id = data.attrib.get('librarySectionID', section.key)
+        for item in page:
+            # Set by fetchItems, plexapi reloads the item when missing
+            item.librarySectionID = section_id
+            yield item
+        total_size = int(data.attrib.get('totalSize') or 0)
+        start += len(page)
+        if not page or (total_size and start >= total_size):
+            break
+
+
+def get_item_guids(item):
+    """External guids of an item, new agents list them separately"""
+    if item.guid.startswith('plex'):
+        return [guid.id for guid in item.guids]
+    return [item.guid]
+
+
+def diff_playlist(current, desired):
+    """
+    Work out the changes that turn a playlist into the desired one
+    :param current: list of (ratingKey, playlistItemID) in playlist order
+    :param desired: list of ratingKeys in the wanted order
+    :return: (remove, add, moves), the playlistItemIDs to remove, the
+             ratingKeys to append and a list of (ratingKey, after) to
+             apply in order, after being None for the top
+    """
+    desired = list(dict.fromkeys(str(k) for k in desired))
+    position = {k: i for i, k in enumerate(desired)}
+    remove = []
+    kept = []
+    seen = set()
+    for rating_key, item_id in current:
+        rating_key = str(rating_key)
+        if rating_key not in position or rating_key in seen:
+            remove.append(item_id)
+            continue
+        seen.add(rating_key)
+        kept.append(rating_key)
+    add = [k for k in desired if k not in seen]
+
+    # Items added are appended, the longest run already in the desired
+    # order stays in place and everything else is moved after the item
+    # that precedes it
+    order = kept + add
+    tails = []
+    tails_idx = []
+    prev = [None] * len(order)
+    for i, rating_key in enumerate(order):
+        pos = position[rating_key]
+        j = bisect.bisect_left(tails, pos)
+        prev[i] = tails_idx[j - 1] if j else None
+        if j == len(tails):
+            tails.append(pos)
+            tails_idx.append(i)
+        else:
+            tails[j] = pos
+            tails_idx[j] = i
+    in_place = set()
+    i = tails_idx[-1] if tails_idx else None
+    while i is not None:
+        in_place.add(order[i])
+        i = prev[i]
+    moves = [(k, desired[pos - 1] if pos else None)
+             for pos, k in enumerate(desired) if k not in in_place]
+    return remove, add, moves
+
+
+class ScanWaiter(object):
+    """Waits for a library section to finish scanning and refreshing
+
+    Listens to the Plex notification websocket (needs websocket-client)
+    to wake up as soon as an activity of the section ends, and polls the
+    activities of the section with an increasing delay otherwise.
+    Scans can be queued behind other activities, so it waits until the
+    section has been busy, start_timeout only guards against a scan that
+    was never seen.
+    """
+    def __init__(self, plex, section_key, start_timeout=300,
+                 max_delay=30):
+        self.plex = plex
+        self.section_key = str(section_key)
+        self.start_timeout = start_timeout
+        self.max_delay = max_delay
+        self._changed = threading.Event()
+        self._ended = False
+        self._listener = None
+
+    def __enter__(self):
+        try:
+            self._listener = self.plex.server.startAlertListener(
+                self._alert)
+        except Exception as e:
+            logs.info(u"Notifications unavailable, polling instead "
+                      u"({})".format(e))
+            self._listener = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._listener:
+            try:
+                self._listener.stop()
+            except Exception:
+                # Listener never connected
+                pass
+
+    def _alert(self, data):
+        for notification in data.get('ActivityNotification', []):
+            activity = notification.get('Activity', {})
+            context = activity.get('Context', {})
+            if str(context.get('librarySectionID')) != self.section_key:
+                continue
+            if notification.get('event') == 'ended':
+                self._ended = True
+            self._changed.set()
+
+    def wait(self):
+        busy_seen = False
+        start = time.time()
+        delay = 0.5
+        while True:
+            if self.plex.is_section_busy(self.section_key):
+                busy_seen = True
+            elif busy_seen or self._ended:
+                return
+            elif time.time() - start >= self.start_timeout:
+                logs.warning(u"No scan of the library seen after {} "
+                             u"seconds, continuing".format(self.start_timeout))
+                return
+            self._changed.wait(delay)
+            self._changed.clear()
+            delay = min(delay * 2, self.max_delay)
+
+
 class Plex(object):
+    max_workers = 8
+
     def __init__(self, baseurl, token):
         self.baseurl = baseurl
         self.token = token
+        self.session = requests.Session()
+        self.session.mount(baseurl, requests.adapters.HTTPAdapter(
+            pool_maxsize=self.max_workers))
+        # Resolved on first use, see invalidate_account()
+        self._account = None
+        self._users = None
+        self._user_tokens = None
+        self._machine_identifier = None
+        self._account_lock = threading.RLock()
+        # Plex instances of the shared users, by username
+        self._user_servers = {}
+        self._user_servers_lock = threading.Lock()
+        # Playlist title: ratingKey, listed on first use
+        self._playlists = None
+        self._playlists_lock = threading.Lock()
         try:
             self.server = plexapi.server.PlexServer(
                 baseurl=baseurl, token=token)
@@ -40,30 +308,116 @@ class Plex(object):
         url = '{base_url}/library/sections'.format(base_url=self.baseurl)
         requests.post(url, headers=headers, params=params)
         
+    @property
+    def account(self):
+        """The plex.tv account of the server owner, signed in once"""
+        with self._account_lock:
+            if self._account is None:
+                self._account = self.server.myPlexAccount()
+            return self._account
+
+    @property
+    def machine_identifier(self):
+        if self._machine_identifier is None:
+            self._machine_identifier = self.server.machineIdentifier
+        return self._machine_identifier
+
+    def invalidate_account(self):
+        """Forget the account, its users and their tokens and servers,
+        e.g. after users were invited or removed
+        """
+        with self._account_lock:
+            self._account = None
+            self._users = None
+            self._user_tokens = None
+        with self._user_servers_lock:
+            self._user_servers = {}
+
     def _user_has_access(self, user):
         for server in user.servers:
-            if server.machineIdentifier == self.server.machineIdentifier:
+            if server.machineIdentifier == self.machine_identifier:
                 return True
         return False
 
+    def _get_user_token(self, user):
+        # One plex.tv request lists the tokens of all the users the
+        # server is shared with, user.get_token() would make one per user
+        with self._account_lock:
+            if self._user_tokens is None:
+                self._user_tokens = {}
+                try:
+                    data = self.account.query(self.account.FRIENDINVITE.format(
+                        machineId=self.machine_identifier))
+                    for elem in data:
+                        self._user_tokens[elem.attrib.get('userID')] = \
+                            elem.attrib.get('accessToken')
+                except Exception as e:
+                    logs.warning(u"Unable to list the user tokens "
+                                 u"({})".format(e))
+            token = self._user_tokens.get(str(user.id))
+        return token or user.get_token(self.machine_identifier)
+
     def _get_plex_instance_for_user(self, user):
+        with self._user_servers_lock:
+            if user.username in self._user_servers:
+                return self._user_servers[user.username]
+        user_server = None
         if self._user_has_access(user):
-            return Plex(baseurl=self.baseurl, token=self.server.myPlexAccount().user(user.username).get_token(
-                self.server.machineIdentifier))
-        return None
+            user_server = Plex(baseurl=self.baseurl, token=self._get_user_token(user))
+        with self._user_servers_lock:
+            return self._user_servers.setdefault(user.username, user_server)
+
+    def _for_users(self, users, action, message, **kwargs):
+        """
+        Run action(user_server) for each user that has access to the
+        server, max_workers users at a time
+        :param message: log message, formatted with user_name and kwargs
+        """
+        def run(user):
+            logs.info(message.format(user_name=user.username, **kwargs))
+            user_server = self._get_plex_instance_for_user(user=user)
+            if user_server:
+                action(user_server)
+            else:
+                logs.info(f"{user.username} does not have access to your server.")
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers) as executor:
+            futures = {executor.submit(run, user): user for user in users}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logs.error(u"Updating the playlist of {} failed: {}".format(
+                        futures[future].username, e))
 
     def _get_all_users(self):
-        return self.server.myPlexAccount().users()
+        with self._account_lock:
+            if self._users is None:
+                self._users = self.account.users()
+            return self._users
 
     def _get_specific_users(self, user_names: List):
-        users = []
-        for user in self._get_all_users():
-            if user.username in user_names:
-                users.append(user)
-        return users
+        user_names = set(user_names)
+        return [user for user in self._get_all_users()
+                if user.username in user_names]
 
     def _create_new_playlist(self, playlist_name, items: List[plexapi.media.Media]):
-        self.server.createPlaylist(title=playlist_name, items=items)
+        playlist = self.server.createPlaylist(title=playlist_name, items=items)
+        with self._playlists_lock:
+            if self._playlists is not None:
+                self._playlists[playlist_name] = str(playlist.ratingKey)
+        return playlist
+
+    def _get_playlist_index(self):
+        with self._playlists_lock:
+            if self._playlists is None:
+                self._playlists = {}
+                for elem in self.server.query('/playlists'):
+                    # Same as a linear search, the first one wins
+                    self._playlists.setdefault(elem.attrib.get('title'),
+                                               elem.attrib.get('ratingKey'))
+            return self._playlists
 
     def _get_existing_playlist(self, playlist_name, user_name: str = None):
         if user_name:
@@ -75,9 +429,15 @@ class Plex(object):
                 else:
                     logs.info(f"{user_name} does not have access to your server.")
         else:
-            for playlist in self.server.playlists():
-                if playlist.title == playlist_name:
-                    return playlist
+            rating_key = self._get_playlist_index().get(playlist_name)
+            if rating_key:
+                try:
+                    return self.server.fetchItem(
+                        '/playlists/{}'.format(rating_key))
+                except plexapi.exceptions.NotFound:
+                    # Deleted outside of this run
+                    with self._playlists_lock:
+                        self._playlists.pop(playlist_name, None)
         return None
 
     def get_playlist_items(self, playlist_name, user_name: str = None):
@@ -96,22 +456,79 @@ class Plex(object):
         # add on admin account
         self.add_to_playlist(playlist_name=playlist_name, items=items)
         # add for all other users
-        for user in users:
-            logs.info("Adding items to {user_name}'s {list_name} playlist".format(user_name=user.username,
-                                                                                  list_name=playlist_name))
-            user_server = self._get_plex_instance_for_user(user=user)
-            if user_server:
-                user_server.add_to_playlist(playlist_name=playlist_name, items=items)
-            else:
-                logs.info(f"{user.username} does not have access to your server.")
+        self._for_users(
+            users,
+            lambda user_server: user_server.add_to_playlist(playlist_name=playlist_name, items=items),
+            "Adding items to {user_name}'s {list_name} playlist", list_name=playlist_name)
 
     def add_to_playlist(self, playlist_name, items: List[plexapi.media.Media]):
         playlist = self._get_existing_playlist(playlist_name=playlist_name)
         if playlist:
-            playlist.addItems(items=items)
-        else:
+            current = self._get_playlist_entries(playlist)
+            present = set(rating_key for rating_key, _ in current)
+            self._add_playlist_items(playlist, [
+                item.ratingKey for item in items
+                if str(item.ratingKey) not in present])
+        elif items:
             self._create_new_playlist(playlist_name=playlist_name, items=items)
 
+    def _get_playlist_entries(self, playlist):
+        """(ratingKey, playlistItemID) of the items of a playlist, in order"""
+        data = self.server.query(
+            '/playlists/{}/items'.format(playlist.ratingKey))
+        return [(elem.attrib.get('ratingKey'),
+                 elem.attrib.get('playlistItemID')) for elem in data]
+
+    def _playlist_request(self, method, path, params=None):
+        headers = {'X-Plex-Token': self.token}
+        url = '{base_url}{path}'.format(base_url=self.baseurl, path=path)
+        r = self.session.request(method, url, headers=headers, params=params)
+        r.raise_for_status()
+
+    def _add_playlist_items(self, playlist, rating_keys, chunk_size=100):
+        """Append items to a playlist, chunk_size items per request"""
+        rating_keys = [str(k) for k in rating_keys]
+        for i in range(0, len(rating_keys), chunk_size):
+            uri = ('server://{server}/com.plexapp.plugins.library'
+                   '/library/metadata/{keys}').format(
+                server=self.machine_identifier,
+                keys=','.join(rating_keys[i:i + chunk_size]))
+            self._playlist_request(
+                'PUT', '/playlists/{}/items'.format(playlist.ratingKey),
+                params={'uri': uri})
+
+    def _remove_playlist_items(self, playlist, item_ids):
+        for item_id in item_ids:
+            self._playlist_request('DELETE', '/playlists/{}/items/{}'.format(
+                playlist.ratingKey, item_id))
+
+    def sync_playlist(self, playlist_name, items: List[plexapi.media.Media]):
+        """
+        Make a playlist hold exactly the given items, in order, with as
+        few requests as possible. The playlist is created if missing.
+        :return: number of changes made
+        """
+        playlist = self._get_existing_playlist(playlist_name=playlist_name)
+        if not playlist:
+            if items:
+                self._create_new_playlist(playlist_name=playlist_name,
+                                          items=items)
+            return len(items)
+        remove, add, moves = diff_playlist(
+            self._get_playlist_entries(playlist),
+            [item.ratingKey for item in items])
+        self._remove_playlist_items(playlist, remove)
+        self._add_playlist_items(playlist, add)
+        if moves:
+            item_ids = dict(self._get_playlist_entries(playlist))
+            for rating_key, after in moves:
+                params = {'after': item_ids[after]} if after else None
+                self._playlist_request(
+                    'PUT', '/playlists/{}/items/{}/move'.format(
+                        playlist.ratingKey, item_ids[rating_key]),
+                    params=params)
+        return len(remove) + len(add) + len(moves)
+
     def remove_from_playlist_for_users(self, playlist_name, items: List[plexapi.media.Media], user_names: List = None,
                                        all_users: bool = False):
         users = []
@@ -122,26 +539,26 @@ class Plex(object):
         # remove on admin account
         self.remove_from_playlist(playlist_name=playlist_name, items=items)
         # remove for all other users
-        for user in users:
-            logs.info("Removing items from {user_name}'s {list_name} playlist".format(user_name=user.username,
-                                                                                      list_name=playlist_name))
-            user_server = self._get_plex_instance_for_user(user=user)
-            if user_server:
-                user_server.remove_from_playlist(playlist_name=playlist_name, items=items)
-            else:
-                logs.info(f"{user.username} does not have access to your server.")
+        self._for_users(
+            users,
+            lambda user_server: user_server.remove_from_playlist(playlist_name=playlist_name, items=items),
+            "Removing items from {user_name}'s {list_name} playlist", list_name=playlist_name)
 
 
     def remove_from_playlist(self, playlist_name, items: List[plexapi.media.Media]):
         playlist = self._get_existing_playlist(playlist_name=playlist_name)
         if playlist:
-            for item in items:
-                playlist.removeItem(item=item)
+            rating_keys = set(str(item.ratingKey) for item in items)
+            self._remove_playlist_items(playlist, [
+                item_id for rating_key, item_id
+                in self._get_playlist_entries(playlist)
+                if rating_key in rating_keys])
 
     def reset_playlist(self, playlist_name, new_items: List[plexapi.media.Media], user_names: List = None,
                        all_users: bool = False):
         """
-        Delete old playlist and remake it with new items
+        Update the playlist to hold exactly the new items, keeping the
+        playlist itself so clients don't have to sync it again
         :param user_names: Make change for specific users, ["name", "name2", "name3"]
         :param all_users: Make change for all users
         :param new_items: list of Media objects
@@ -155,20 +572,98 @@ class Plex(object):
             users = self._get_specific_users(user_names=user_names)
         if users:  # recursively reset for self and for each user
             self.reset_playlist(playlist_name=playlist_name, new_items=new_items)
-            for user in users:
-                logs.info("Resetting {list_name} playlist for {user_name}".format(list_name=playlist_name,
-                                                                                  user_name=user.username))
-                user_server = self._get_plex_instance_for_user(user=user)
-                if user_server:
-                    user_server.reset_playlist(playlist_name=playlist_name, new_items=new_items)
-                else:
-                    logs.info(f"{user.username} does not have access to your server.")
+            self._for_users(
+                users,
+                lambda user_server: user_server.reset_playlist(playlist_name=playlist_name, new_items=new_items),
+                "Resetting {list_name} playlist for {user_name}", list_name=playlist_name)
 
         else:
-            playlist = self._get_existing_playlist(playlist_name=playlist_name)
-            if playlist:
-                playlist.delete()
-            self._create_new_playlist(playlist_name=playlist_name, items=new_items)
+            self.sync_playlist(playlist_name=playlist_name, items=new_items)
+
+    def fetch_items(self, items, chunk_size=100):
+        """Rehydrate PlexItem records into full plexapi objects, fetching
+        chunk_size items per request
+        """
+        full_items = {}
+        rating_keys = [str(item.ratingKey) for item in items]
+        for i in range(0, len(rating_keys), chunk_size):
+            key = '/library/metadata/{}'.format(
+                ','.join(rating_keys[i:i + chunk_size]))
+            for item in self.server.fetchItems(key):
+                full_items[str(item.ratingKey)] = item
+        return [full_items[k] for k in rating_keys if k in full_items]
+
+    def scan_section(self, section, paths=None, max_paths=25):
+        """
+        Scan only the given folders of a library section
+        :param paths: changed folders, None to scan the whole section
+        :param max_paths: scan the whole section if more folders changed
+        :return: whether a scan was started
+        """
+        if paths is not None:
+            paths = sorted(set(paths))
+            if not paths:
+                return False
+        if paths is None or len(paths) > max_paths:
+            section.update()
+            return True
+        headers = {'X-Plex-Token': self.token}
+        url = '{base_url}/library/sections/{key}/refresh'.format(
+            base_url=self.baseurl, key=section.key)
+        for path in paths:
+            try:
+                r = self.session.get(url, headers=headers,
+                                     params={'path': path})
+                r.raise_for_status()
+            except requests.RequestException as e:
+                logs.warning(u"Partial scan of {path} failed, scanning the "
+                             u"whole library ({e})".format(path=path, e=e))
+                section.update()
+                return True
+        return True
+
+    def get_section_signature(self, section):
+        """Returns the number of items in a section, when the newest was
+        added and when the section was last updated, which change whenever
+        items are added, removed, upgraded or matched again
+        """
+        key = '/library/sections/{}/all?sort=addedAt:desc'.format(
+            section.key)
+        headers = {
+            'X-Plex-Container-Start': '0',
+            'X-Plex-Container-Size': '1',
+        }
+        data = self.server.query(key, headers=headers)
+        newest = next(iter(data), None)
+        updated_at = section.updatedAt
+        return [data.attrib.get('totalSize', data.attrib.get('size')),
+                newest.attrib.get('addedAt') if newest is not None else None,
+                int(updated_at.timestamp()) if updated_at else None]
+
+    def scan_waiter(self, section_key):
+        return ScanWaiter(self, section_key)
+
+    def is_section_busy(self, section_key):
+        """Whether a section is being scanned or refreshed, without
+        loading all the library sections
+        """
+        section_key = str(section_key)
+        try:
+            data = self.server.query('/activities')
+        except plexapi.exceptions.PlexApiException:
+            # Older servers, check the section listing instead
+            data = self.server.query('/library/sections')
+            for directory in data.iter('Directory'):
+                if directory.attrib.get('key') == section_key:
+                    return directory.attrib.get('refreshing') in ('1', 'true')
+            return False
+        for activity in data.iter('Activity'):
+            if not activity.attrib.get('type', '').startswith('library.'):
+                continue
+            for context in activity.iter('Context'):
+                if context.attrib.get('librarySectionID') == section_key:
+                    return True
+        return False
 
     def _get_section_by_name(self, section_name):
         try:
@@ -183,9 +678,8 @@ class Plex(object):
             return section.locations
         return []
 
-    def set_sort_title(self, library_key, rating_key, number, title,
-                       library_type, title_format, visible=False):
-        headers = {'X-Plex-Token': self.token}
+    def _get_sort_title_params(self, rating_key, number, title, library_type,
+                               title_format, visible=False):
         if library_type == 'movie':
             search_type = 1
         elif library_type == 'tv':
@@ -205,7 +699,44 @@ class Plex(object):
         else:
             params['title.value'] = title
             params['title.locked'] = 0
+        return params
 
+    def _put_sort_title(self, library_key, params):
+        headers = {'X-Plex-Token': self.token}
         url = "{base_url}/library/sections/{library}/all".format(
             base_url=self.baseurl, library=library_key)
-        requests.put(url, headers=headers, params=params)
+        self.session.put(url, headers=headers, params=params)
+
+    def set_sort_title(self, library_key, rating_key, number, title,
+                       library_type, title_format, visible=False):
+        params = self._get_sort_title_params(
+            rating_key, number, title, library_type, title_format, visible)
+        self._put_sort_title(library_key, params)
+
+    def set_sort_titles(self, library_key, updates, library_type,
+                        title_format, visible=False):
+        """
+        Set the sort titles of several items in parallel
+        :param updates: list of (item, number, title), where item has the
+                        current ratingKey, title and titleSort
+        :return: number of items that were changed
+        """
+        changed = []
+        for item, number, title in updates:
+            params = self._get_sort_title_params(
+                item.ratingKey, number, title, library_type, title_format,
+                visible)
+            if item.titleSort == params['titleSort.value'] \
+                    and item.title == params['title.value']:
+                continue
+            changed.append(params)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._put_sort_title, library_key,
+                                       params) for params in changed]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logs.error(u"Setting sort title failed: {}".format(e))
+        return len(changed)
@@ -2,13 +2,14 @@
 """recipe
 """
 
+import bisect
+import concurrent.futures
 import datetime
-import errno
 import os
 import random
 import subprocess
 import sys
-import time
+import threading
 import logs
 import json
 
@@ -18,16 +19,89 @@ import plexutils
 import tmdb
 import traktutils
 import imdbutils
+import libraryindex
 import tvdb
 from config import ConfigParser
 from recipes import RecipeParser
-from utils import Colors, add_years
+from utils import Colors, ItemIds, PathIndex, add_years
+
+
+class GuidCache():
+    """Per-section store of external guids for new-agent Plex items
+
+    Changes are kept in memory and only written to disk on flush(), or
+    every checkpoint_interval changes, instead of once per item.
+    """
+    def __init__(self, cache_file, checkpoint_interval=1000):
+        self.cache_file = cache_file
+        self.checkpoint_interval = checkpoint_interval
+        self._cache = None
+        self._dirty = 0
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._cache is not None:
+            return
+        self._cache = dict()
+        if not os.path.isfile(self.cache_file):
+            return
+        with open(self.cache_file, 'r') as f:
+            try:
+                self._cache = json.load(f)
+            except Exception as e:
+                logs.warning("Unable to read cache, recreating ({})".format(e))
+        if not isinstance(self._cache, dict):
+            logs.warning("Unable to read cache, recreating")
+            self._cache = dict()
+
+    def section(self, section_id):
+        with self._lock:
+            self._load()
+            return self._cache.setdefault(str(section_id), dict())
+
+    def get(self, section_id, guid, updated_at):
+        entry = self.section(section_id).get(guid)
+        if isinstance(entry, list):
+            # Old cache format, guids only
+            self.set(section_id, guid, entry, updated_at)
+            return entry
+        try:
+            if entry['updatedAt'] >= updated_at:
+                return entry['guids']
+        except (KeyError, TypeError):
+            if entry is not None:
+                logs.warning("Cache error, overwriting")
+        return None
+
+    def set(self, section_id, guid, guids, updated_at):
+        with self._lock:
+            self.section(section_id)[guid] = {
+                'guids': guids,
+                'updatedAt': updated_at
+            }
+            self._dirty += 1
+            if self.checkpoint_interval and \
+                    self._dirty >= self.checkpoint_interval:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_file = self.cache_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self._cache, f)
+            os.replace(tmp_file, self.cache_file)
+            self._dirty = 0
 
 
 class IdMap():
     def __init__(self, matching_only=False, cache_file=None,
-                 match_imdb=None, match_tmdb=None, match_tvdb=None):
+                 match_imdb=None, match_tmdb=None, match_tvdb=None,
+                 page_size=500, cache=None):
         self.items = set()
+        # Reverse index of the (id dict, id) pairs of each item
+        self._keys = {}
         self.imdb = {}
         self.tmdb = {}
         self.tvdb = {}
@@ -36,29 +110,75 @@ class IdMap():
             self.cache_file = cache_file
         else:
             self.cache_file = 'plex_guid_cache.json'
-        self.cache = None
-        self.cache_section = None
-        self.cache_section_id = None
+        self.cache = cache or GuidCache(self.cache_file)
+        self.page_size = page_size
         if matching_only:
             self.match_imdb = match_imdb or []
             self.match_tmdb = match_tmdb or []
             self.match_tvdb = match_tvdb or []
 
     def add_libraries(self, libraries):
-        for library in libraries:
-            self.add_items(library.all())
+        try:
+            for library in libraries:
+                self._add_items(plexutils.iter_section_items(
+                    library, page_size=self.page_size))
+        finally:
+            self.cache.flush()
 
     def add_items(self, items):
-        while items:
-            self.add_item(items.pop(0))  # Pop to save on memory
+        try:
+            self._add_items(items)
+        finally:
+            self.cache.flush()
+
+    def _add_items(self, items):
+        for item in items:
+            self.add_item(item)
 
     def add_item(self, item):
         if item.guid.startswith('plex'):
             guids = self._get_guids(item)
-            for guid in guids:
-                self._add_id(guid, item)
         else:
-            self._add_id(item.guid, item)
+            guids = [item.guid]
+        ids = self._parse_guids(guids, item)
+        if ids is not None:
+            self._add_record(plexutils.PlexItem(item), ids)
+
+    def add_record(self, record, guids):
+        """Add an already compacted PlexItem with its external guids"""
+        ids = self._parse_guids(guids, record)
+        if ids is not None:
+            self._add_record(record, ids)
+
+    def add_indexed_libraries(self, libraries, index_dir):
+        """Add all items of the libraries from their persisted index,
+        refreshing only what changed since it was saved
+        """
+        for library in libraries:
+            index = libraryindex.LibraryIndex(library, index_dir,
+                                              page_size=self.page_size)
+            index.refresh()
+            for record, guids in index.entries():
+                self.add_record(record, guids)
+
+    def _parse_guids(self, guids, item):
+        """Returns the ids to add the item under, None if the item
+        shouldn't be added
+        """
+        ids = []
+        for guid in guids:
+            id_ = self._parse_guid(guid, item)
+            if id_:
+                ids.append(id_)
+        if not ids and (self.matching_only or not guids):
+            return None
+        return ids
+
+    def _add_record(self, record, ids):
+        for d, id_ in ids:
+            d[id_] = record
+        self._keys[record] = ids
+        self.items.add(record)
 
     def get(self, imdb=None, tmdb=None, tvdb=None):
         item = None
@@ -90,108 +210,116 @@ class IdMap():
         return item
 
     def _get_guids(self, item):
-        self._load_cache(str(item.librarySectionID))
-        guids = []
+        section_id = str(item.librarySectionID)
         try:
             ts = item.updatedAt.timestamp()
         except AttributeError:
             logs.warning("Missing updatedAt timestamp for {} ({})".format(
                 item.title, item.year))
             ts = 0
-        try:
-            if (item.guid in self.cache and
-                    self.cache[item.guid]['updatedAt'] >= ts):
-                guids = self.cache[item.guid]['guids']
-        except (KeyError, TypeError):
-            logs.warning("Cache error, overwriting")
-            guids = self.cache[item.guid]
-            self.cache[item.guid] = {
-                'guids': guids,
-                'updatedAt': ts
-            }
-            self._save_cache()
+        guids = self.cache.get(section_id, item.guid, ts)
         if not guids:
+            # Already included when fetched through iter_section_items,
+            # otherwise plexapi reloads the item
             guids = [guid.id for guid in item.guids]
             if guids:
-                self.cache[item.guid] = {
-                    'guids': guids,
-                    'updatedAt': ts
-                }
-                self._save_cache()
+                self.cache.set(section_id, item.guid, guids, ts)
         return guids
 
-    def _load_cache(self, section_id):
-        if self.cache and self.cache_section_id == section_id:
-            return
-        if not os.path.isfile(self.cache_file):
-            with open(self.cache_file, 'w') as f:
-                json.dump(dict(), f)
-        with open(self.cache_file, 'r') as f:
-            try:
-                self._cache = json.load(f)
-            except Exception as e:
-                logs.warning("Unable to read cache, recreating ({})".format(e))
-                self._cache = dict()
-        self.cache = self._cache.get(section_id, dict())
-
-        self.cache_section_id = section_id
-
-    def _save_cache(self):
-        self._cache[self.cache_section_id] = self.cache
-        with open(self.cache_file, 'w') as f:
-            json.dump(self._cache, f)
-
-    def _add_id(self, guid, item):
+    def _parse_guid(self, guid, item):
+        """Returns the (id dict, id) pair for a guid, or None if the guid
+        is unknown or not matched when matching_only
+        """
         try:
             source, id_ = guid.split('://', 1)
         except ValueError:
             logs.warning(f"Unknown guid: {guid}")
-            return
+            return None
         id_ = id_.split('?')[0]
         if 'imdb' in source:
             if '/' in id_:
                 id_ = id_.split('/')[-2]
             if self.matching_only and not id_ in self.match_imdb:
-                return
-            self.imdb[id_] = item
+                return None
+            return self.imdb, id_
         elif 'tmdb' in source or 'themoviedb' in source:
             if self.matching_only and not id_ in self.match_tmdb:
-                return
-            self.tmdb[id_] = item
+                return None
+            return self.tmdb, id_
         elif 'tvdb' in source or 'thetvdb' in source:
             if '/' in id_:
                 id_ = id_.split('/')[-2]
             if self.matching_only and not id_ in self.match_tvdb:
-                return
-            self.tvdb[id_] = item
+                return None
+            return self.tvdb, id_
         else:
             logs.warning(f"Unknown guid: {guid}. "
                          f"Possibly unmatched: {item.title} ({item.year})")
-        self.items.add(item)
+        return None
 
     def _popall(self, item):
         items = []
-        for d in (self.imdb, self.tmdb, self.tvdb):
-            keys = []
-            for k, v in d.items():
-                if v is item:
-                    keys.append(k)
-            for k in keys:
-                items.append(d.pop(k))
+        for d, id_ in self._keys.pop(item, []):
+            # The id may have been taken over by another item
+            if d.get(id_) is item:
+                items.append(d.pop(id_))
         return items
 
 
+class SharedClients():
+    """Connections, caches and source library maps shared by all the
+    recipes run in one process
+    """
+    def __init__(self, config):
+        self.config = config
+        self.guid_cache = GuidCache(
+            config.get('guid_cache_file') or 'plex_guid_cache.json')
+        self._clients = {}
+        self._source_maps = {}
+        self._lock = threading.Lock()
+        self._source_map_locks = {}
+
+    def get_client(self, key, factory):
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = factory()
+            return self._clients[key]
+
+    def get_source_map(self, libraries):
+        """Returns a map of all the items in the libraries, built once"""
+        key = tuple(sorted(str(library.key) for library in libraries))
+        with self._lock:
+            lock = self._source_map_locks.setdefault(key, threading.Lock())
+        # Other recipes using the same libraries wait for the first one
+        with lock:
+            if key not in self._source_maps:
+                source_map = IdMap(cache=self.guid_cache)
+                if self.config.get('source_index_dir'):
+                    source_map.add_indexed_libraries(
+                        libraries, self.config['source_index_dir'])
+                else:
+                    source_map.add_libraries(libraries)
+                self._source_maps[key] = source_map
+            return self._source_maps[key]
+
+
 class Recipe():
     plex = None
     trakt = None
     tmdb = None
     tvdb = None
+    symlink_workers = 8
+    list_workers = 8
+    # Symlinks that couldn't be created in the last run
+    symlink_failures = 0
 
-    def __init__(self, recipe_name, sort_only=False, config_file=None, use_playlists=False):
+    def __init__(self, recipe_name, sort_only=False, config_file=None, use_playlists=False,
+                 shared=None):
         self.recipe_name = recipe_name
         self.use_playlists = use_playlists
+        self.shared = shared
 
-        self.config = ConfigParser(config_file)
+        self.config = shared.config if shared else ConfigParser(config_file)
         self.recipe = RecipeParser(recipe_name)
 
         if not self.config.validate():
@@ -209,56 +337,95 @@ class Recipe():
 
         self.source_library_config = self.recipe['source_libraries']
 
-        self.plex = plexutils.Plex(self.config['plex']['baseurl'],
-                                   self.config['plex']['token'])
+        self.plex = self._get_client('plex', lambda: plexutils.Plex(
+            self.config['plex']['baseurl'], self.config['plex']['token']))
 
         if self.config['trakt']['username']:
-            self.trakt = traktutils.Trakt(
+            trakt_oauth = self.recipe.get('trakt_oauth', False)
+            self.trakt = self._get_client(('trakt', trakt_oauth), lambda: traktutils.Trakt(
                 self.config['trakt']['username'],
                 client_id=self.config['trakt']['client_id'],
                 client_secret=self.config['trakt']['client_secret'],
                 oauth_token=self.config['trakt'].get('oauth_token', ''),
-                oauth=self.recipe.get('trakt_oauth', False),
-                config=self.config)
+                oauth=trakt_oauth,
+                config=self.config,
+                page_size=self.config['trakt'].get('page_size', 100),
+                cache_file=self.config['trakt'].get('cache_file')))
             if self.trakt.oauth_token:
                 self.config['trakt']['oauth_token'] = self.trakt.oauth_token
 
         if self.config['tmdb']['api_key']:
-            self.tmdb = tmdb.TMDb(
+            self.tmdb = self._get_client('tmdb', lambda: tmdb.TMDb(
                 self.config['tmdb']['api_key'],
-                cache_file=self.config['tmdb']['cache_file'])
+                cache_file=self.config['tmdb']['cache_file'],
+                cache_ttl=self.config['tmdb'].get('cache_ttl'),
+                rate_limit=self.config['tmdb'].get('rate_limit', 3),
+                rate_limit_burst=self.config['tmdb'].get('rate_limit_burst',
+                                                         10)))
 
         if self.config['tvdb']['username']:
-            self.tvdb = tvdb.TheTVDB(self.config['tvdb']['username'],
-                                     self.config['tvdb']['api_key'],
-                                     self.config['tvdb']['user_key'])
+            self.tvdb = self._get_client('tvdb', lambda: tvdb.TheTVDB(
+                self.config['tvdb']['username'],
+                self.config['tvdb']['api_key'],
+                self.config['tvdb']['user_key'],
+                cache_file=self.config['tvdb'].get('cache_file'),
+                cache_ttl=self.config['tvdb'].get('cache_ttl')))
 
         self.imdb = imdbutils.IMDb(self.tmdb, self.tvdb)
 
-        self.source_map = IdMap(matching_only=True,
-                                cache_file=self.config.get('guid_cache_file'))
-        self.dest_map = IdMap(cache_file=self.config.get('guid_cache_file'))
-
+        if shared:
+            guid_cache = shared.guid_cache
+        else:
+            guid_cache = GuidCache(self.config.get('guid_cache_file') or
+                                   'plex_guid_cache.json')
+        self.source_map = IdMap(matching_only=True, cache=guid_cache)
+        self.dest_map = IdMap(cache=guid_cache)
+
+    def _get_client(self, key, factory):
+        if self.shared:
+            return self.shared.get_client(key, factory)
+        return factory()
+
+    @property
+    def target(self):
+        """The library or playlist the recipe creates"""
+        if self.use_playlists:
+            return 'playlist', self.recipe['new_playlist']['name']
+        return 'library', self.recipe['new_library']['name']
 
+    def _get_trakt_list(self, url, max_age):
+        if 'api.trakt.tv' in url:
+            source = self.trakt
+        else:
+            source = self.imdb
+        (item_list, item_ids) = source.add_items(
+            self.library_type, url, None, None, max_age)
+        return item_list
 
     def _get_trakt_lists(self):
-        item_list = []  # TODO Replace with dict, scrap item_ids?
-        item_ids = []
-
-        for url in self.recipe['source_list_urls']:
-            max_age = (self.recipe['new_playlist'].get('max_age', 0) if self.use_playlists
-                       else self.recipe['new_library'].get('max_age', 0))
-            if 'api.trakt.tv' in url:
-                (item_list, item_ids) = self.trakt.add_items(
-                    self.library_type, url, item_list, item_ids,
-                    max_age or 0)
-            elif 'imdb.com/chart' in url:
-                (item_list, item_ids) = self.imdb.add_items(
-                    self.library_type, url, item_list, item_ids,
-                    max_age or 0)
-            else:
+        item_list = []
+        item_ids = ItemIds()
+
+        urls = list(self.recipe['source_list_urls'])
+        for url in urls:
+            if 'api.trakt.tv' not in url and 'imdb.com/chart' not in url:
                 raise Exception("Unsupported source list: {url}".format(
                     url=url))
+        max_age = (self.recipe['new_playlist'].get('max_age', 0) if self.use_playlists
+                   else self.recipe['new_library'].get('max_age', 0))
+
+        # Fetch all lists at once, then merge them in the configured order
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self.list_workers, len(urls))) as executor:
+            url_lists = list(executor.map(
+                lambda url: self._get_trakt_list(url, max_age or 0), urls))
+        for url_list in url_lists:
+            for item in url_list:
+                # Skip already added items
+                if item in item_ids:
+                    continue
+                item_list.append(item)
+                item_ids.add(item)
 
         if self.recipe['weighted_sorting']['enabled']:
             if self.config['tmdb']['api_key']:
@@ -284,6 +451,14 @@ class Recipe():
             source_libraries.append(source_library)
         return source_libraries
 
+    def _get_library_roots(self):
+        # Resolve the source library folders once per run
+        roots = []
+        for library_config in self.source_library_config:
+            roots.extend(self.plex.get_library_paths(
+                library_name=library_config['name']))
+        return PathIndex(roots)
+
     def _get_matching_items(self, source_libraries, item_list):
         matching_items = []
         missing_items = []
@@ -305,7 +480,7 @@ class Recipe():
                 continue
 
             matching_total += 1
-            matching_items += res
+            matching_items.append(res)
 
             if not self.use_playlists and self.recipe['new_library']['sort_title']['absolute']:
                 logs.info(u"{} {} ({})".format(
@@ -320,149 +495,151 @@ class Recipe():
 
         return matching_items, missing_items, matching_total, nonmatching_idx, max_count
 
-    def _create_symbolic_links(self, matching_items, matching_total):
+    def _create_symbolic_links(self, matching_items, matching_total,
+                               plan_file=None):
         logs.info(u"Creating symlinks for {count} matching items in the "
                   u"library...".format(count=matching_total))
 
         try:
-            if not os.path.exists(self.recipe['new_library']['folder']):
+            # A plan only reads the filesystem, a missing folder is empty
+            if not plan_file and \
+                    not os.path.exists(self.recipe['new_library']['folder']):
                 os.mkdir(self.recipe['new_library']['folder'])
         except:
             logs.error(u"Unable to create the new library folder "
                        u"'{folder}'.".format(folder=self.recipe['new_library']['folder']))
             logs.info(u"Exiting script.")
-            return 0
+            return None
+
+        plan = self._plan_symbolic_links(matching_items)
+        if plan_file:
+            with open(plan_file, 'w') as f:
+                json.dump([{k: v for k, v in link.items() if k != 'item'}
+                           for link in plan], f, indent=2)
+            logs.info(u"Wrote the plan for {count} new symlinks to "
+                      u"{file}".format(count=len(plan), file=plan_file))
+            return []
 
-        count = 0
         updated_paths = []
         new_items = []
-        if self.library_type == 'movie':
-            for movie in matching_items:
-                for part in movie.iterParts():
-                    old_path_file = part.file
-                    old_path, file_name = os.path.split(old_path_file)
-
-                    folder_name = ''
-                    for library_config in self.source_library_config:
-                        for f in self.plex.get_library_paths(library_name=library_config['name']):
-                            f = os.path.abspath(f)
-                            if old_path.lower().startswith(f.lower()):
-                                folder_name = os.path.relpath(old_path, f)
-                                break
-                        else:
-                            continue
-
-                        if folder_name == '.':
-                            new_path = os.path.join(
-                                self.recipe['new_library']['folder'],
-                                file_name)
-                            dir = False
-                        else:
-                            new_path = os.path.join(
-                                self.recipe['new_library']['folder'],
-                                folder_name)
-                            dir = True
-                            parent_path = os.path.dirname(
-                                os.path.abspath(new_path))
-                            if not os.path.exists(parent_path):
-                                try:
-                                    os.makedirs(parent_path)
-                                except OSError as e:
-                                    if e.errno == errno.EEXIST \
-                                            and os.path.isdir(parent_path):
-                                        pass
-                                    else:
-                                        raise
-                            # Clean up old, empty directories
-                            if os.path.exists(new_path) \
-                                    and not os.listdir(new_path):
-                                os.rmdir(new_path)
-
-                        if (dir and not os.path.exists(new_path)) \
-                                or not dir and not os.path.isfile(new_path):
-                            try:
-                                if os.name == 'nt':
-                                    if dir:
-                                        subprocess.call(['mklink', '/D',
-                                                         new_path, old_path],
-                                                        shell=True)
-                                    else:
-                                        subprocess.call(['mklink', new_path,
-                                                         old_path_file],
-                                                        shell=True)
-                                else:
-                                    if dir:
-                                        os.symlink(old_path, new_path)
-                                    else:
-                                        os.symlink(old_path_file, new_path)
-                                count += 1
-                                new_items.append(movie)
-                                updated_paths.append(new_path)
-                            except Exception as e:
-                                logs.error(u"Symlink failed for {path}: {e}".format(
-                                    path=new_path, e=e))
-        else:
-            for tv_show in matching_items:
-                done = False
-                if done:
-                    continue
-                for episode in tv_show.episodes():
-                    if done:
-                        break
-                    for part in episode.iterParts():
-                        old_path_file = part.file
-                        old_path, file_name = os.path.split(old_path_file)
-
-                        folder_name = ''
-                        for library_config in self.source_library_config:
-                            for f in self.plex.get_library_paths(library_name=library_config['name']):
-                                if old_path.lower().startswith(f.lower()):
-                                    old_path = os.path.join(f,
-                                                            old_path.replace(
-                                                                f, '').strip(
-                                                                os.sep).split(
-                                                                os.sep)[0])
-                                    folder_name = os.path.relpath(old_path, f)
-                                    break
-                            else:
-                                continue
-
-                            new_path = os.path.join(
-                                self.recipe['new_library']['folder'],
-                                folder_name)
-
-                            if not os.path.exists(new_path):
-                                try:
-                                    if os.name == 'nt':
-                                        subprocess.call(['mklink', '/D',
-                                                         new_path, old_path],
-                                                        shell=True)
-                                    else:
-                                        os.symlink(old_path, new_path)
-                                    count += 1
-                                    new_items.append(tv_show)
-                                    updated_paths.append(new_path)
-                                    done = True
-                                    break
-                                except Exception as e:
-                                    logs.error(u"Symlink failed for {path}: {e}"
-                                               .format(path=new_path, e=e))
-                            else:
-                                done = True
-                                break
+        self.symlink_failures = 0
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.symlink_workers) as executor:
+            # map() keeps the plan order for the log
+            for link, ok in zip(plan, executor.map(self._apply_symbolic_link,
+                                                   plan)):
+                if ok:
+                    new_items.append(link['item'])
+                    updated_paths.append(link['link'] if link['dir']
+                                         else os.path.dirname(link['link']))
+                else:
+                    self.symlink_failures += 1
 
-        logs.info(u"Created symlinks for {count} new items:".format(count=count))
+        logs.info(u"Created symlinks for {count} new items:".format(count=len(new_items)))
         for item in new_items:
             logs.info(u"{title} ({year})".format(title=item.title, year=getattr(item, 'year', None)))
-
-    def _verify_new_library_and_get_items(self, create_if_not_found=False):
+        return updated_paths
+
+    def _plan_symbolic_links(self, matching_items):
+        """Returns the symlinks that are missing from the new library folder
+
+        The folder is listed once, only links nested in subfolders are
+        checked separately.
+        """
+        new_library_folder = self.recipe['new_library']['folder']
+        library_roots = self._get_library_roots()
+        existing = {}
+        if os.path.isdir(new_library_folder):
+            for entry in os.scandir(new_library_folder):
+                existing[entry.name] = entry
+        plan = []
+        planned = set()
+
+        def _add(item, source, link_name, dir):
+            link = os.path.join(new_library_folder, link_name)
+            if link in planned:
+                return
+            head = link_name.split(os.sep)[0]
+            if os.sep in link_name:
+                present = os.path.lexists(link)
+            else:
+                present = head in existing
+            remove_empty_dir = False
+            if present and dir and os.sep not in link_name:
+                entry = existing[head]
+                # Clean up old, empty directories
+                if entry.is_dir(follow_symlinks=False) \
+                        and not os.listdir(entry.path):
+                    present = False
+                    remove_empty_dir = True
+            if present:
+                return
+            planned.add(link)
+            plan.append({
+                'item': item,
+                'title': item.title,
+                'year': getattr(item, 'year', None),
+                'source': source,
+                'link': link,
+                'dir': dir,
+                'remove_empty_dir': remove_empty_dir,
+            })
+
+        plexutils.fetch_locations(matching_items)
+        for item in matching_items:
+            for old_path_file in item.get_locations():
+                if self.library_type == 'movie':
+                    old_path, file_name = os.path.split(old_path_file)
+                else:
+                    old_path = old_path_file
+                f = library_roots.find(old_path)
+                if not f:
+                    continue
+                folder_name = os.path.relpath(old_path, f)
+                if self.library_type == 'movie':
+                    if folder_name == '.':
+                        _add(item, old_path_file, file_name, False)
+                    else:
+                        _add(item, old_path, folder_name, True)
+                else:
+                    # Link the top level show folder
+                    folder_name = folder_name.split(os.sep)[0]
+                    _add(item, os.path.join(f, folder_name), folder_name,
+                         True)
+                    break
+        return plan
+
+    def _apply_symbolic_link(self, link):
+        new_path = link['link']
+        try:
+            if link['remove_empty_dir']:
+                os.rmdir(new_path)
+            parent_path = os.path.dirname(os.path.abspath(new_path))
+            os.makedirs(parent_path, exist_ok=True)
+            if os.name == 'nt':
+                if link['dir']:
+                    subprocess.call(['mklink', '/D', new_path,
+                                     link['source']], shell=True)
+                else:
+                    subprocess.call(['mklink', new_path, link['source']],
+                                    shell=True)
+            else:
+                os.symlink(link['source'], new_path)
+        except Exception as e:
+            logs.error(u"Symlink failed for {path}: {e}".format(
+                path=new_path, e=e))
+            return False
+        return True
+
+    def _verify_new_library_and_get_items(self, create_if_not_found=False,
+                                          updated_paths=None):
         # Check if the new library exists in Plex
+        scan = False
         try:
             new_library = self.plex.server.library.section(
                 self.recipe['new_library']['name'])
             logs.info(u"Library already exists in Plex. Scanning the library...")
-
-            new_library.update()
+            scan = True
         except plexapi.exceptions.NotFound:
             if create_if_not_found:
                 self.plex.create_new_library(
@@ -476,13 +653,11 @@ class Recipe():
                     library=self.recipe['new_library']['name']))
 
         # Wait for metadata to finish downloading before continuing
-        logs.info(u"Waiting for metadata to finish downloading...")
-        new_library = self.plex.server.library.section(
-            self.recipe['new_library']['name'])
-        while new_library.refreshing:
-            time.sleep(5)
-            new_library = self.plex.server.library.section(
-                self.recipe['new_library']['name'])
+        with self.plex.scan_waiter(new_library.key) as waiter:
+            if not scan or self.plex.scan_section(new_library,
+                                                  updated_paths):
+                logs.info(u"Waiting for metadata to finish downloading...")
+                waiter.wait()
 
         # Retrieve a list of items from the new library
         logs.info(u"Retrieving a list of items from the '{library}' library in "
@@ -494,49 +669,44 @@ class Recipe():
         if self.recipe['new_library']['sort']:
             logs.info(u"Setting the sort titles for the '{}' library".format(
                 self.recipe['new_library']['name']))
+        sort_updates = []
         if self.recipe['new_library']['sort_title']['absolute']:
             for i, m in enumerate(item_list):
                 item = self.dest_map.pop(m.get('id'), m.get('tmdb_id'), m.get('tvdb_id'))
                 if item and self.recipe['new_library']['sort']:
-                    self.plex.set_sort_title(
-                        new_library.key, item.ratingKey, i + 1, m['title'],
-                        self.library_type,
-                        self.recipe['new_library']['sort_title']['format'],
-                        self.recipe['new_library']['sort_title']['visible']
-                    )
+                    sort_updates.append((item, i + 1, m['title']))
         else:
             i = 0
             for m in item_list:
                 i += 1
                 item = self.dest_map.pop(m.get('id'), m.get('tmdb_id'), m.get('tvdb_id'))
                 if item and self.recipe['new_library']['sort']:
-                    self.plex.set_sort_title(
-                        new_library.key, item.ratingKey, i, m['title'],
-                        self.library_type,
-                        self.recipe['new_library']['sort_title']['format'],
-                        self.recipe['new_library']['sort_title']['visible']
-                    )
+                    sort_updates.append((item, i, m['title']))
         unmatched_items = list(self.dest_map.items)
+        updated_paths = []
         if not sort_only and (
                 self.recipe['new_library']['remove_from_library'] or
                 self.recipe['new_library'].get('remove_old', False)):
             # Remove old items that no longer qualify
-            self._remove_old_items_from_library(unmatched_items)
-        elif sort_only:
-            return True
-        if self.recipe['new_library']['sort'] and \
+            updated_paths = self._remove_old_items_from_library(
+                unmatched_items)
+        if self.recipe['new_library']['sort'] and not sort_only and \
                 not self.recipe['new_library']['remove_from_library']:
             unmatched_items.sort(key=lambda x: x.titleSort)
-            while unmatched_items:
-                item = unmatched_items.pop(0)
+            for item in unmatched_items:
                 i += 1
                 logs.info(u"{} {} ({})".format(i, item.title, item.year))
-                self.plex.set_sort_title(
-                    new_library.key, item.ratingKey, i, item.title,
-                    self.library_type,
-                    self.recipe['new_library']['sort_title']['format'],
-                    self.recipe['new_library']['sort_title']['visible'])
-        all_new_items = self._cleanup_new_library(new_library=new_library)
+                sort_updates.append((item, i, item.title))
+        if sort_updates:
+            count = self.plex.set_sort_titles(
+                new_library.key, sort_updates, self.library_type,
+                self.recipe['new_library']['sort_title']['format'],
+                self.recipe['new_library']['sort_title']['visible'])
+            logs.info(u"Updated the sort titles of {} items".format(count))
+        if sort_only:
+            return True
+        all_new_items = self._cleanup_new_library(
+            new_library=new_library, updated_paths=updated_paths)
         return all_new_items
 
     def _remove_old_items_from_library(self, unmatched_items):
@@ -547,6 +717,7 @@ class Recipe():
         deleted_items = []
         max_date = add_years(
             (self.recipe['new_library']['max_age'] or 0) * -1)
+        plexutils.fetch_locations(unmatched_items)
         if self.library_type == 'movie':
             for movie in unmatched_items:
                 if not self.recipe['new_library']['remove_from_library']:
@@ -556,8 +727,7 @@ class Recipe():
                                 max_date < movie.originallyAvailableAt):
                         continue
 
-                for part in movie.iterParts():
-                    old_path_file = part.file
+                for old_path_file in movie.get_locations():
                     old_path, file_name = os.path.split(old_path_file)
 
                     folder_name = os.path.relpath(
@@ -590,7 +760,9 @@ class Recipe():
                                 os.unlink(new_path)
                             count += 1
                             deleted_items.append(movie)
-                            updated_paths.append(new_path)
+                            updated_paths.append(
+                                new_path if dir
+                                else os.path.dirname(new_path))
                         except Exception as e:
                             logs.error(u"Remove symlink failed for "
                                        "{path}: {e}".format(path=new_path, e=e))
@@ -599,72 +771,130 @@ class Recipe():
                 done = False
                 if done:
                     continue
-                for episode in tv_show.episodes():
+                for old_path in tv_show.get_locations():
                     if done:
                         break
-                    for part in episode.iterParts():
-                        if done:
-                            break
-                        old_path_file = part.file
-                        old_path, file_name = os.path.split(old_path_file)
-
-                        folder_name = ''
-                        new_library_folder = \
-                            self.recipe['new_library']['folder']
-                        old_path = os.path.join(
-                            new_library_folder,
-                            old_path.replace(new_library_folder, '').strip(
-                                os.sep).split(os.sep)[0])
-                        folder_name = os.path.relpath(old_path,
-                                                      new_library_folder)
-
-                        new_path = os.path.join(
-                            self.recipe['new_library']['folder'],
-                            folder_name)
-                        if os.path.exists(new_path):
-                            try:
-                                if os.name == 'nt':
-                                    # Python 3.2+ only
-                                    if sys.version_info < (3, 2):
-                                        assert os.path.islink(new_path)
-                                    os.rmdir(new_path)
-                                else:
+                    folder_name = ''
+                    new_library_folder = \
+                        self.recipe['new_library']['folder']
+                    old_path = os.path.join(
+                        new_library_folder,
+                        old_path.replace(new_library_folder, '').strip(
+                            os.sep).split(os.sep)[0])
+                    folder_name = os.path.relpath(old_path,
+                                                  new_library_folder)
+
+                    new_path = os.path.join(
+                        self.recipe['new_library']['folder'],
+                        folder_name)
+                    if os.path.exists(new_path):
+                        try:
+                            if os.name == 'nt':
+                                # Python 3.2+ only
+                                if sys.version_info < (3, 2):
                                     assert os.path.islink(new_path)
-                                    os.unlink(new_path)
-                                count += 1
-                                deleted_items.append(tv_show)
-                                updated_paths.append(new_path)
-                                done = True
-                                break
-                            except Exception as e:
-                                logs.error(u"Remove symlink failed for "
-                                           "{path}: {e}".format(path=new_path,
-                                                                e=e))
-                        else:
+                                os.rmdir(new_path)
+                            else:
+                                assert os.path.islink(new_path)
+                                os.unlink(new_path)
+                            count += 1
+                            deleted_items.append(tv_show)
+                            updated_paths.append(new_path)
                             done = True
                             break
+                        except Exception as e:
+                            logs.error(u"Remove symlink failed for "
+                                       "{path}: {e}".format(path=new_path,
+                                                            e=e))
+                    else:
+                        done = True
+                        break
 
         logs.info(u"Removed symlinks for {count} items.".format(count=count))
         for item in deleted_items:
             logs.info(u"{title} ({year})".format(title=item.title,
                                                  year=item.year))
+        return updated_paths
 
-    def _cleanup_new_library(self, new_library):
+    def _cleanup_new_library(self, new_library, updated_paths=None):
         # Scan the library to clean up the deleted items
-        logs.info(u"Scanning the '{library}' library...".format(
-            library=self.recipe['new_library']['name']))
-        new_library.update()
-        time.sleep(10)
-        new_library = self.plex.server.library.section(
-            self.recipe['new_library']['name'])
-        while new_library.refreshing:
-            time.sleep(5)
-            new_library = self.plex.server.library.section(
-                self.recipe['new_library']['name'])
+        if updated_paths != []:
+            logs.info(u"Scanning the '{library}' library...".format(
+                library=self.recipe['new_library']['name']))
+            with self.plex.scan_waiter(new_library.key) as waiter:
+                self.plex.scan_section(new_library, updated_paths)
+                waiter.wait()
         new_library.emptyTrash()
         return new_library.all()
 
-    def _run(self, share_playlist_to_all=False):
+    def _get_state_file(self):
+        state_dir = self.config.get('state_dir')
+        if not state_dir:
+            return None
+        return os.path.join(state_dir, '{}.json'.format(self.recipe_name))
+
+    def _get_run_inputs(self, item_list, source_libraries,
+                        share_playlist_to_all):
+        """Everything a run depends on, if none of it changed the
+        library/playlist is already up to date
+        """
+        inputs = {
+            'recipe': self.recipe.data,
+            'use_playlists': self.use_playlists,
+            'share_playlist_to_all': share_playlist_to_all,
+            'items': [(m.get('id'), m.get('tmdb_id'), m.get('tvdb_id'))
+                      for m in item_list],
+            'source_libraries': [self.plex.get_section_signature(library)
+                                 for library in source_libraries],
+        }
+        # Normalize to what the state file reads back
+        return json.loads(json.dumps(inputs, default=str))
+
+    def _load_state(self, state_file):
+        if not os.path.isfile(state_file):
+            return None
+        with open(state_file, 'r') as f:
+            try:
+                return json.load(f)
+            except ValueError as e:
+                logs.warning(u"Unable to read the recipe state, ignoring "
+                             u"({})".format(e))
+                return None
+
+    def _save_state(self, state_file, inputs, item_list, matching_items,
+                    missing_items, count):
+        state = {
+            'inputs': inputs,
+            'rating_keys': [item.ratingKey for item in matching_items],
+            'sort_order': [m.get('id') or m.get('tmdb_id') or m.get('tvdb_id')
+                           for m in item_list],
+            'missing_items': [
+                (i, {k: item[k] for k in ('id', 'title', 'year',
+                                          'release_date') if k in item})
+                for i, item in missing_items],
+            'count': count,
+        }
+        state_dir = os.path.dirname(state_file)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        tmp_file = state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, default=str)
+        os.replace(tmp_file, state_file)
+
+    def _get_output_size(self):
+        """Number of items in the library/playlist, None if it's missing"""
+        if self.use_playlists:
+            playlist = self.plex._get_existing_playlist(
+                playlist_name=self.recipe['new_playlist']['name'])
+            return int(playlist.leafCount) if playlist else None
+        section = self.plex._get_section_by_name(
+            self.recipe['new_library']['name'])
+        if not section:
+            return None
+        return int(self.plex.get_section_signature(section)[0] or 0)
+
+    def _run(self, share_playlist_to_all=False, symlink_plan_file=None):
         # Get the trakt lists
         item_list, item_ids = self._get_trakt_lists()
         force_imdb_id_match = False
@@ -672,15 +902,37 @@ class Recipe():
         # Get list of items from the Plex server
         source_libraries = self._get_plex_libraries()
 
+        # Skip the run if nothing changed since the last one
+        state_file = None if symlink_plan_file else self._get_state_file()
+        if state_file:
+            inputs = self._get_run_inputs(item_list, source_libraries,
+                                          share_playlist_to_all)
+            state = self._load_state(state_file)
+            # Items removed from the library/playlist by hand are put
+            # back by a full run
+            if state and state.get('inputs') == inputs \
+                    and self._get_output_size() == state.get('count'):
+                logs.info(u"The lists and source libraries haven't changed "
+                          u"since the last run, nothing to do")
+                return ([tuple(m) for m in state['missing_items']],
+                        state['count'])
+
         # Populate source library guid map
-        for item in item_list:
-            if item.get('id'):
-                self.source_map.match_imdb.append(item['id'])
-            if item.get('tmdb_id'):
-                self.source_map.match_tmdb.append(item['tmdb_id'])
-            if item.get('tvdb_id'):
-                self.source_map.match_tvdb.append(item['tvdb_id'])
-        self.source_map.add_libraries(source_libraries)
+        if self.shared:
+            self.source_map = self.shared.get_source_map(source_libraries)
+        elif self.config.get('source_index_dir'):
+            self.source_map = IdMap(cache=self.source_map.cache)
+            self.source_map.add_indexed_libraries(
+                source_libraries, self.config['source_index_dir'])
+        else:
+            for item in item_list:
+                if item.get('id'):
+                    self.source_map.match_imdb.append(item['id'])
+                if item.get('tmdb_id'):
+                    self.source_map.match_tmdb.append(item['tmdb_id'])
+                if item.get('tvdb_id'):
+                    self.source_map.match_tvdb.append(item['tvdb_id'])
+            self.source_map.add_libraries(source_libraries)
 
         # Create a list of matching items
         matching_items, missing_items, matching_total, nonmatching_idx, max_count = self._get_matching_items(
@@ -688,6 +940,7 @@ class Recipe():
 
         if self.use_playlists:
             # Start playlist process
+            matching_items = self.plex.fetch_items(matching_items)
             if self.recipe['new_playlist']['remove_from_playlist'] or self.recipe['new_playlist'].get('remove_old',
                                                                                                       False):
                 # Start playlist over again
@@ -703,20 +956,36 @@ class Recipe():
                                                     all_users=(share_playlist_to_all if share_playlist_to_all else
                                                                self.recipe['new_playlist'].get('share_to_all', False)))
             playlist_items = self.plex.get_playlist_items(playlist_name=self.recipe['new_playlist']['name'])
-            return missing_items, (len(playlist_items) if playlist_items else 0)
+            count = len(playlist_items) if playlist_items else 0
         else:
             # Start library process
             # Create symlinks for all items in your library on the trakt watched
-            self._create_symbolic_links(matching_items=matching_items, matching_total=matching_total)
+            updated_paths = self._create_symbolic_links(matching_items=matching_items,
+                                                        matching_total=matching_total,
+                                                        plan_file=symlink_plan_file)
+            if symlink_plan_file:
+                # Dry run
+                return missing_items, matching_total
             # Post-process new library
             logs.info(u"Creating the '{}' library in Plex...".format(
                 self.recipe['new_library']['name']))
-            new_library, all_new_items = self._verify_new_library_and_get_items(create_if_not_found=True)
+            new_library, all_new_items = self._verify_new_library_and_get_items(
+                create_if_not_found=True, updated_paths=updated_paths)
             self.dest_map.add_items(all_new_items)
             # Modify the sort titles
             all_new_items = self._modify_sort_titles_and_cleanup(
                     item_list, new_library, sort_only=False)
-            return missing_items, len(all_new_items)
+            count = len(all_new_items)
+        if state_file and self.symlink_failures:
+            # Try the failed symlinks again next time
+            logs.warning(u"{} symlinks failed, not skipping the next "
+                         u"run".format(self.symlink_failures))
+            if os.path.isfile(state_file):
+                os.remove(state_file)
+        elif state_file:
+            self._save_state(state_file, inputs, item_list, matching_items,
+                             missing_items, count)
+        return missing_items, count
 
     def _run_sort_only(self):
         item_list, item_ids = self._get_trakt_lists()
@@ -730,7 +999,8 @@ class Recipe():
                                              sort_only=True)
         return len(all_new_items)
 
-    def run(self, sort_only=False, share_playlist_to_all=False):
+    def run(self, sort_only=False, share_playlist_to_all=False,
+            symlink_plan_file=None):
         if sort_only:
             logs.info(u"Running the recipe '{}', sorting only".format(
                 self.recipe_name))
@@ -739,7 +1009,8 @@ class Recipe():
                 count=list_count, library_or_playlist=('playlist' if self.use_playlists else 'library')))
         else:
             logs.info(u"Running the recipe '{}'".format(self.recipe_name))
-            missing_items, list_count = self._run(share_playlist_to_all=share_playlist_to_all)
+            missing_items, list_count = self._run(share_playlist_to_all=share_playlist_to_all,
+                                                  symlink_plan_file=symlink_plan_file)
             logs.info(u"Number of items in the new {library_or_playlist}: {count}".format(
                 count=list_count, library_or_playlist=('playlist' if self.use_playlists else 'library')))
             logs.info(u"Number of missing items: {count}".format(
@@ -751,10 +1022,14 @@ class Recipe():
                     year=item['year']))
 
     def weighted_sorting(self, item_list):
+        def _parse_date(date):
+            # Faster than strptime, TMDb dates start with YYYY-MM-DD
+            return datetime.date.fromisoformat(date[:10])
+
         def _get_non_theatrical_release(release_dates):
             # Returns earliest release date that is not theatrical
             # TODO PREDB
-            types = {}
+            release_date = None
             for country in release_dates.get('results', []):
                 # FIXME Look at others too?
                 if country['iso_3166_1'] != 'US':
@@ -762,28 +1037,24 @@ class Recipe():
                 for d in country['release_dates']:
                     if d['type'] in (4, 5, 6):
                         # 4: Digital, 5: Physical, 6: TV
-                        types[str(d['type'])] = datetime.datetime.strptime(
-                            d['release_date'], '%Y-%m-%dT%H:%M:%S.%fZ').date()
+                        date = _parse_date(d['release_date'])
+                        if not release_date or date < release_date:
+                            release_date = date
                 break
-
-            release_date = None
-            for t, d in types.items():
-                if not release_date or d < release_date:
-                    release_date = d
-
             return release_date
 
+        if self.library_type == 'movie':
+            # Everything younger than this will get 1
+            min_days = 180
+            # Everything older than this will get 0
+            max_days = (float(self.recipe['new_library']['max_age'])
+                        / 4.0 * 365.25 or 360)
+        else:
+            min_days = 14
+            max_days = (float(self.recipe['new_library']['max_age'])
+                        / 4.0 * 365.25 or 180)
+
         def _get_age_weight(days):
-            if self.library_type == 'movie':
-                # Everything younger than this will get 1
-                min_days = 180
-                # Everything older than this will get 0
-                max_days = (float(self.recipe['new_library']['max_age'])
-                            / 4.0 * 365.25 or 360)
-            else:
-                min_days = 14
-                max_days = (float(self.recipe['new_library']['max_age'])
-                            / 4.0 * 365.25 or 180)
             if days <= min_days:
                 return 1
             elif days >= max_days:
@@ -794,14 +1065,21 @@ class Recipe():
         total_items = len(item_list)
 
         weights = self.recipe['weighted_sorting']['weights']
+        # Lower case genre: combined factor
+        genre_bias = {}
+        for genre, value in weights['genre_bias'].items():
+            genre_bias[genre.lower()] = genre_bias.get(genre.lower(), 1) * value
+        # A fixed seed gives the same order for the same list
+        rng = random.Random(self.recipe['weighted_sorting'].get('random_seed'))
 
         # TMDB details
         today = datetime.date.today()
-        total_tmdb_vote = 0.0
         tmdb_votes = []
+        all_details = self.tmdb.get_details_many(
+            [m['tmdb_id'] for m in item_list], self.library_type)
         for i, m in enumerate(item_list):
             m['original_idx'] = i + 1
-            details = self.tmdb.get_details(m['tmdb_id'], self.library_type)
+            details = all_details.get(m['tmdb_id'])
             if not details:
                 logs.warning(u"Warning: No TMDb data for {}".format(m['title']))
                 continue
@@ -809,20 +1087,16 @@ class Recipe():
             m['tmdb_vote'] = float(details['vote_average'])
             m['tmdb_vote_count'] = int(details['vote_count'])
             if self.library_type == 'movie':
+                m['release_date'] = None
                 if self.recipe['weighted_sorting']['better_release_date']:
                     m['release_date'] = _get_non_theatrical_release(
-                        details['release_dates']) or \
-                                        datetime.datetime.strptime(
-                                            details['release_date'],
-                                            '%Y-%m-%d').date()
-                else:
-                    m['release_date'] = datetime.datetime.strptime(
-                        details['release_date'], '%Y-%m-%d').date()
+                        details['release_dates'])
+                if not m['release_date']:
+                    m['release_date'] = _parse_date(details['release_date'])
                 item_age_td = today - m['release_date']
             elif self.library_type == 'tv':
                 try:
-                    m['last_air_date'] = datetime.datetime.strptime(
-                        details['last_air_date'], '%Y-%m-%d').date()
+                    m['last_air_date'] = _parse_date(details['last_air_date'])
                 except TypeError:
                     m['last_air_date'] = today
                 item_age_td = today - m['last_air_date']
@@ -831,8 +1105,6 @@ class Recipe():
             if (self.library_type == 'tv' or m['tmdb_vote_count'] > 150 or
                     m['age'] > 50):
                 tmdb_votes.append(m['tmdb_vote'])
-            total_tmdb_vote += m['tmdb_vote']
-            item_list[i] = m
 
         tmdb_votes.sort()
 
@@ -844,15 +1116,18 @@ class Recipe():
             if m.get('tmdb_popularity'):
                 if (self.library_type == 'tv' or
                         m.get('tmdb_vote_count') > 150 or m['age'] > 50):
-                    vote_weight = ((tmdb_votes.index(m['tmdb_vote']) + 1)
-                                   / float(len(tmdb_votes)))
+                    # Rank among the other votes, ties share their mean rank
+                    rank = (bisect.bisect_left(tmdb_votes, m['tmdb_vote'])
+                            + bisect.bisect_right(tmdb_votes, m['tmdb_vote'])
+                            + 1) / 2.0
+                    vote_weight = rank / len(tmdb_votes)
                 else:
                     # Assume below average rating for new/less voted items
                     vote_weight = 0.25
                 age_weight = _get_age_weight(float(m['age']))
 
                 if weights.get('random'):
-                    random_weight = random.random()
+                    random_weight = rng.random()
                     m['random_weight'] = random_weight * weights['random']
                 else:
                     m['random_weight'] = 0.0
@@ -862,16 +1137,14 @@ class Recipe():
 
                 weight = (m['index_weight'] + m['vote_weight']
                           + m['age_weight'] + m['random_weight'])
-                for genre, value in weights['genre_bias'].items():
-                    if genre.lower() in m['genres']:
-                        weight *= value
+                for genre in m['genres']:
+                    weight *= genre_bias.get(genre, 1)
 
                 m['weight'] = weight
             else:
                 m['vote_weight'] = 0.0
                 m['age_weight'] = 0.0
                 m['weight'] = index_weight
-            item_list[i] = m
 
         item_list.sort(key=lambda m: m['weight'], reverse=True)
 
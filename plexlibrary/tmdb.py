@@ -1,109 +1,129 @@
 # -*- coding: utf-8 -*-
+import concurrent.futures
 import json
-import shelve
-import time
-try:
-    from cPickle import UnpicklingError
-except ImportError:
-    from pickle import UnpicklingError
 
 import requests
 
 import logs
+from cache import ShelveCache
+from utils import TokenBucket
 
 
 class TMDb(object):
     api_key = None
     cache_file = None
-    request_count = 0
-
-    def __init__(self, api_key, cache_file=None):
+    max_workers = 8
+    max_retries = 3
+    # Seconds to keep the responses of each endpoint
+    default_cache_ttl = {
+        'details': 3600 * 24,
+        'external_ids': 3600 * 24 * 7,
+        'find': 3600 * 24 * 7,
+        'not_found': 3600 * 24,
+    }
+
+    def __init__(self, api_key, cache_file=None, cache_ttl=None,
+                 rate_limit=3, rate_limit_burst=10):
         self.api_key = api_key
         if cache_file:
             self.cache_file = cache_file
         else:
             self.cache_file = 'tmdb_details.shelve'
+        self.cache_ttl = dict(self.default_cache_ttl)
+        if cache_ttl:
+            self.cache_ttl.update(cache_ttl)
+        self.cache = ShelveCache(self.cache_file)
+        self.rate_limiter = TokenBucket(rate_limit, rate_limit_burst)
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_maxsize=self.max_workers))
+
+    def _get_cached(self, endpoint, library_type, id_):
+        return self.cache.lookup('{}:{}'.format(endpoint, library_type), id_,
+                                 ttl=self.cache_ttl[endpoint])
+
+    def _set_cached(self, endpoint, library_type, id_, value):
+        # Remember "not found" too, but not for as long
+        self.cache.store('{}:{}'.format(endpoint, library_type), id_, value,
+                         not_found_ttl=self.cache_ttl['not_found'])
+
+    def _request(self, url, params=None):
+        """Returns (found, data), found is None if the request failed"""
+        params = dict(params or {})
+        params['api_key'] = self.api_key
+        for _ in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                r = self.session.get(url, params=params)
+            except requests.RequestException as e:
+                logs.warning(u"TMDb request failed: {}".format(e))
+                return None, None
+            if r.status_code != 429:
+                break
+            try:
+                retry_after = float(r.headers.get('Retry-After', 10))
+            except ValueError:
+                retry_after = 10
+            logs.info(u"Waiting {} seconds for the TMDb rate limit...".format(
+                retry_after))
+            self.rate_limiter.pause(retry_after)
+
+        if r.status_code == 200:
+            return True, json.loads(r.text)
+        elif r.status_code == 404:
+            return False, None
+        return None, None
+
+    def _get_many(self, method, ids, library_type):
+        """Runs method for each of ids concurrently, returns a dict of
+        id: result
+        """
+        ids = list(dict.fromkeys(ids))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers) as executor:
+            results = executor.map(lambda id_: method(id_, library_type),
+                                   ids)
+            return dict(zip(ids, results))
+
+    def get_details_many(self, tmdb_ids, library_type='movie'):
+        return self._get_many(self.get_details, tmdb_ids, library_type)
+
+    def get_tmdb_from_imdb_many(self, imdb_ids, library_type):
+        return self._get_many(self.get_tmdb_from_imdb, imdb_ids,
+                              library_type)
 
     def get_imdb_id(self, tmdb_id, library_type='movie'):
         if library_type not in ('movie', 'tv'):
             raise Exception("Library type should be 'movie' or 'tv'")
 
-        # Use cache
-        cache = shelve.open(self.cache_file)
-        if str(tmdb_id) in cache:
-            try:
-                cache_item = cache[str(tmdb_id)]
-            except (EOFError, UnpicklingError):
-                # Cache file error, clear
-                cache.close()
-                cache = shelve.open(self.cache_file, 'n')
-            else:
-                if (cache_item['cached'] + 3600 * 24) > int(time.time()):
-                    cache.close()
-                    return cache_item.get('imdb_id')
-
-        # Wait 10 seconds for the TMDb rate limit
-        if self.request_count >= 40:
-            logs.info(u"Waiting 10 seconds for the TMDb rate limit...")
-            time.sleep(10)
-            self.request_count = 0
-
-        params = {
-            'api_key': self.api_key,
-        }
-
         if library_type == 'movie':
-            url = "https://api.themoviedb.org/3/movie/{tmdb_id}".format(
-                tmdb_id=tmdb_id)
-        else:
-            url = ("https://api.themoviedb.org/3/tv/{tmdb_id}/external_ids"
-                   .format(tmdb_id=tmdb_id))
-        r = requests.get(url, params=params)
+            # The movie details include the IMDb id
+            item = self.get_details(tmdb_id, library_type)
+            return item.get('imdb_id') if item else None
 
-        self.request_count += 1
+        # Use cache
+        hit, item = self._get_cached('external_ids', library_type, tmdb_id)
+        if hit:
+            return item.get('imdb_id') if item else None
 
-        if r.status_code == 200:
-            item = json.loads(r.text)
-            item['cached'] = int(time.time())
-            cache[str(tmdb_id)] = item
-            cache.close()
-            return item.get('imdb_id')
-        else:
-            return None
+        url = ("https://api.themoviedb.org/3/tv/{tmdb_id}/external_ids"
+               .format(tmdb_id=tmdb_id))
+        found, item = self._request(url)
+
+        if found is not None:
+            self._set_cached('external_ids', library_type, tmdb_id, item)
+        return item.get('imdb_id') if item else None
 
     def get_details(self, tmdb_id, library_type='movie'):
         if library_type not in ('movie', 'tv'):
             raise Exception("Library type should be 'movie' or 'tv'")
 
         # Use cache
-        cache = shelve.open(self.cache_file)
-        if str(tmdb_id) in cache:
-            try:
-                cache_item = cache[str(tmdb_id)]
-            except (EOFError, UnpicklingError):
-                # Cache file error, clear
-                cache.close()
-                cache = shelve.open(self.cache_file, 'n')
-            except:
-                # Unknown cache file error, clear
-                logs.error(u"Error in loading cache: {}".format(e))
-                cache.close()
-                cache = shelve.open(self.cache_file, 'n')
-            else:
-                if (cache_item['cached'] + 3600 * 24) > int(time.time()):
-                    cache.close()
-                    return cache_item
-
-        # Wait 10 seconds for the TMDb rate limit
-        if self.request_count >= 40:
-            logs.info(u"Waiting 10 seconds for the TMDb rate limit...")
-            time.sleep(10)
-            self.request_count = 0
-
-        params = {
-            'api_key': self.api_key,
-        }
+        hit, item = self._get_cached('details', library_type, tmdb_id)
+        if hit:
+            return item
 
+        params = {}
         if library_type == 'movie':
             params['append_to_response'] = 'release_dates'
             url = "https://api.themoviedb.org/3/movie/{tmdb_id}".format(
@@ -111,70 +131,41 @@ class TMDb(object):
         else:
             url = "https://api.themoviedb.org/3/tv/{tmdb_id}".format(
                     tmdb_id=tmdb_id)
-        r = requests.get(url, params=params)
-
-        self.request_count += 1
+        found, item = self._request(url, params=params)
 
-        if r.status_code == 200:
-            item = json.loads(r.text)
-            item['cached'] = int(time.time())
-            cache[str(tmdb_id)] = item
-            cache.close()
-            return item
-        else:
-            return None
+        if found is not None:
+            self._set_cached('details', library_type, tmdb_id, item)
+        return item
 
     def get_tmdb_from_imdb(self, imdb_id, library_type):
         if library_type not in ('movie', 'tv'):
             raise Exception("Library type should be 'movie' or 'tv'")
 
         # Use cache
-        cache = shelve.open(self.cache_file)
-        if str(imdb_id) in cache:
-            try:
-                cache_item = cache[str(imdb_id)]
-            except (EOFError, UnpicklingError):
-                # Cache file error, clear
-                cache.close()
-                cache = shelve.open(self.cache_file, 'n')
-            else:
-                if (cache_item['cached'] + 3600 * 24) > int(time.time()):
-                    cache.close()
-                    return cache_item
-
-        # Wait 10 seconds for the TMDb rate limit
-        if self.request_count >= 40:
-            logs.info(u"Waiting 10 seconds for the TMDb rate limit...")
-            time.sleep(10)
-            self.request_count = 0
+        hit, media_result = self._get_cached('find', library_type, imdb_id)
+        if hit:
+            return media_result
 
         params = {
-            'api_key': self.api_key,
             'external_source': 'imdb_id'
         }
 
         url = "https://api.themoviedb.org/3/find/{imdb_id}".format(
             imdb_id=imdb_id)
 
-        r = requests.get(url, params=params)
-
-        self.request_count += 1
+        found, item = self._request(url, params=params)
 
         media_result = None
 
-        if r.status_code == 200:
-            item = json.loads(r.text)
-
+        if item:
             if library_type == 'movie':
-                if item and item.get('movie_results'):
+                if item.get('movie_results'):
                     media_result = item.get('movie_results')[0]
             else:
-                if item and item.get('tv_results'):
+                if item.get('tv_results'):
                     media_result = item.get('tv_results')[0]
 
-            if media_result:
-                media_result['cached'] = int(time.time())
-                cache[str(imdb_id)] = media_result
+        if found is not None:
+            self._set_cached('find', library_type, imdb_id, media_result)
 
-        cache.close()
         return media_result
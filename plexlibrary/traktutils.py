@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 import datetime
 import json
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import requests
 import trakt
 import logs
 
-from utils import add_years
+from cache import ShelveCache
+from utils import ItemIds, add_years
 
 
 class Trakt(object):
+    # Validated with ETag/Last-Modified, so they can be kept for long
+    cache_ttl = 3600 * 24 * 30
+
     def __init__(self, username, client_id='', client_secret='',
-                 oauth_token='', oauth=False, config=None):
+                 oauth_token='', oauth=False, config=None, page_size=100,
+                 cache_file=None):
         self.config = config
+        self.page_size = page_size
+        self.session = requests.Session()
+        self.cache = ShelveCache(cache_file or 'trakt.shelve',
+                                 ttl=self.cache_ttl)
         self.username = username
         self.client_id = client_id
         self.client_secret = client_secret
@@ -39,12 +49,14 @@ class Trakt(object):
             logs.info(u"Added new OAuth token to the config file under trakt:")
             logs.info(u"    oauth_token: '{}'".format(self.oauth_token))
 
-    def _handle_request(self, method, url, data=None):
+    def _request(self, method, url, data=None, extra_headers=None):
         """Stolen from trakt.core to support optional OAUTH operations
         :todo: Fix trakt
         """
         headers = {'Content-Type': 'application/json',
                    'trakt-api-version': '2'}
+        if extra_headers:
+            headers.update(extra_headers)
         # self.logger.debug('%s: %s', method, url)
         headers['trakt-api-key'] = self.client_id
         if self.oauth:
@@ -52,11 +64,12 @@ class Trakt(object):
         # self.logger.debug('headers: %s', str(headers))
         # self.logger.debug('method, url :: %s, %s', method, url)
         if method == 'get':  # GETs need to pass data as params, not body
-            response = requests.request(method, url, params=data,
-                                        headers=headers)
+            response = self.session.request(method, url, params=data,
+                                            headers=headers)
         else:
-            response = requests.request(method, url, data=json.dumps(data),
-                                        headers=headers)
+            response = self.session.request(method, url,
+                                            data=json.dumps(data),
+                                            headers=headers)
         # self.logger.debug('RESPONSE [%s] (%s): %s',
         #     method, url, str(response))
         if response.status_code in self.trakt_core.error_map:
@@ -64,29 +77,100 @@ class Trakt(object):
                 # OAuth token probably expired
                 logs.warning(u"Trakt OAuth token invalid/expired")
                 self.oauth_auth()
-                return self._handle_request(method, url, data)
+                return self._request(method, url, data, extra_headers)
             raise self.trakt_core.error_map[response.status_code]()
-        elif response.status_code == 204:  # HTTP no content
-            return None
-        json_data = json.loads(response.content.decode('UTF-8', 'ignore'))
-        return json_data
+        return response
+
+    def _get_page(self, url, params):
+        """GET a single page, revalidating a cached copy with its
+        ETag/Last-Modified instead of downloading it again
+        """
+        key = url + '?' + urlencode(sorted(params.items()))
+        try:
+            cached = self.cache.get(key)
+        except KeyError:
+            cached = None
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        response = self._request('get', url, params, extra_headers=headers)
+        if response.status_code == 304 and cached:
+            return cached['data'], cached['page_count']
+        if response.status_code == 204:  # HTTP no content
+            return [], 1
+        data = json.loads(response.content.decode('UTF-8', 'ignore'))
+        page_count = int(response.headers.get('X-Pagination-Page-Count', 1))
+        if response.headers.get('ETag') \
+                or response.headers.get('Last-Modified'):
+            self.cache.set(key, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'data': data,
+                'page_count': page_count,
+            })
+        return data, page_count
+
+    def _get_list(self, url, data=None):
+        """GET the items of a list, following the X-Pagination headers
+
+        A limit in the url is the total number of items to return, which
+        are fetched page_size items at a time. Without a limit the url is
+        fetched as is, catalog endpoints like movies/trending then return
+        Trakt's default page only.
+        """
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        params = dict(parse_qsl(query))
+        params.update(data or {})
+        url = urlunsplit((scheme, netloc, path, '', fragment))
+        limit = int(params.get('limit') or 0)
+        if 'page' in params or not limit:
+            # A specific page, or a single request
+            return self._get_page(url, params)[0]
+        del params['limit']
+        page = 1
+
+        # Pages are offset by the page size, so keep it the same
+        page_size = min(self.page_size, limit)
+        items = []
+        while True:
+            params['page'] = page
+            params['limit'] = page_size
+            page_items, page_count = self._get_page(url, params)
+            if isinstance(page_items, dict):
+                # Not a list endpoint
+                return page_items
+            items.extend(page_items)
+            if page >= page_count or len(page_items) < page_size \
+                    or len(items) >= limit:
+                break
+            page += 1
+        return items[:limit]
 
     def add_movies(self, url, movie_list=None, movie_ids=None, max_age=0):
         if not movie_list:
             movie_list = []
-        if not movie_ids:
-            movie_ids = []
+        if movie_ids is None:
+            movie_ids = ItemIds(movie_list)
         max_date = add_years(max_age * -1)
         logs.info(u"Retrieving the trakt list: {}".format(url))
         data = {}
         if max_age != 0:
             data['extended'] = 'full'
-        movie_data = self._handle_request('get', url, data=data)
+        movie_data = self._get_list(url, data=data)
         for m in movie_data:
             if 'movie' not in m:
                 m['movie'] = m
+            movie = {
+                'id': m['movie']['ids']['imdb'],
+                'tmdb_id': str(m['movie']['ids'].get('tmdb') or ''),
+                'title': m['movie']['title'],
+                'year': m['movie']['year'],
+            }
             # Skip already added movies
-            if m['movie']['ids']['imdb'] in movie_ids:
+            if movie in movie_ids:
                 continue
             if not m['movie']['year']:  # TODO: Handle this better?
                 continue
@@ -95,34 +179,34 @@ class Trakt(object):
                     and (max_date > datetime.datetime.strptime(
                         m['movie']['released'], '%Y-%m-%d')):
                 continue
-            movie_list.append({
-                'id': m['movie']['ids']['imdb'],
-                'tmdb_id': str(m['movie']['ids'].get('tmdb', '')),
-                'title': m['movie']['title'],
-                'year': m['movie']['year'],
-            })
-            movie_ids.append(m['movie']['ids']['imdb'])
-            if m['movie']['ids'].get('tmdb'):
-                movie_ids.append('tmdb' + str(m['movie']['ids']['tmdb']))
+            movie_list.append(movie)
+            movie_ids.add(movie)
 
         return movie_list, movie_ids
 
     def add_shows(self, url, show_list=None, show_ids=None, max_age=0):
         if not show_list:
             show_list = []
-        if not show_ids:
-            show_ids = []
+        if show_ids is None:
+            show_ids = ItemIds(show_list)
         curyear = datetime.datetime.now().year
         logs.info(u"Retrieving the trakt list: {}".format(url))
         data = {}
         if max_age != 0:
             data['extended'] = 'full'
-        show_data = self._handle_request('get', url, data=data)
+        show_data = self._get_list(url, data=data)
         for m in show_data:
             if 'show' not in m:
                 m['show'] = m
+            show = {
+                'id': m['show']['ids']['imdb'],
+                'tmdb_id': str(m['show']['ids'].get('tmdb') or ''),
+                'tvdb_id': str(m['show']['ids'].get('tvdb') or ''),
+                'title': m['show']['title'],
+                'year': m['show']['year'],
+            }
             # Skip already added shows
-            if m['show']['ids']['imdb'] in show_ids:
+            if show in show_ids:
                 continue
             if not m['show']['year']:
                 continue
@@ -130,18 +214,8 @@ class Trakt(object):
             if max_age != 0 \
                     and (curyear - (max_age - 1)) > int(m['show']['year']):
                 continue
-            show_list.append({
-                'id': m['show']['ids']['imdb'],
-                'tmdb_id': str(m['show']['ids'].get('tmdb', '')),
-                'tvdb_id': str(m['show']['ids'].get('tvdb', '')),
-                'title': m['show']['title'],
-                'year': m['show']['year'],
-            })
-            show_ids.append(m['show']['ids']['imdb'])
-            if m['show']['ids'].get('tmdb'):
-                show_ids.append('tmdb' + str(m['show']['ids']['tmdb']))
-            if m['show']['ids'].get('tvdb'):
-                show_ids.append('tvdb' + str(m['show']['ids']['tvdb']))
+            show_list.append(show)
+            show_ids.add(show)
 
         return show_list, show_ids
 
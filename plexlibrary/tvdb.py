@@ -1,35 +1,98 @@
 # -*- coding: utf-8 -*-
-import requests
+import base64
 import json
+import time
+
+import requests
+
+from cache import ShelveCache
 
 
 class TheTVDB(object):
     token = None
+    token_expires = 0
+    # Seconds to keep the responses of each endpoint
+    default_cache_ttl = {
+        'series': 3600 * 24 * 7,
+        'search': 3600 * 24 * 7,
+        'not_found': 3600 * 24,
+    }
 
-    def __init__(self, username, api_key, user_key):
+    def __init__(self, username, api_key, user_key, cache_file=None,
+                 cache_ttl=None):
         self.username = username
         self.api_key = api_key
         self.user_key = user_key
+        self.cache_ttl = dict(self.default_cache_ttl)
+        if cache_ttl:
+            self.cache_ttl.update(cache_ttl)
+        self.cache = ShelveCache(cache_file or 'tvdb.shelve')
+        self.session = requests.Session()
+
+    def _request(self, url, params=None):
+        """Returns (found, data), found is None on any other error than
+        a 404
+        """
+        for _ in range(2):
+            self._ensure_token()
+            headers = {
+                'Authorization': 'Bearer {token}'.format(token=self.token)
+            }
+            r = self.session.get(url, headers=headers, params=params)
+            if r.status_code != 401:
+                break
+            # Token revoked or expired early
+            self.token = None
+
+        if r.status_code == 200:
+            return True, r.json()
+        elif r.status_code == 404:
+            return False, None
+        return None, None
 
     def get_imdb_id(self, tvdb_id):
-        # TODO Cache
-        if not self.token:
-            self._refresh_token()
+        hit, imdb_id = self.cache.lookup('series', tvdb_id,
+                                         ttl=self.cache_ttl['series'])
+        if hit:
+            return imdb_id
 
         url = "https://api.thetvdb.com/series/{tvdb_id}".format(
             tvdb_id=tvdb_id)
-        headers = {
-            'Authorization': 'Bearer {token}'.format(token=self.token)
-        }
-        r = requests.get(url, headers=headers)
+        found, tv_show = self._request(url)
 
-        if r.status_code == 200:
-            tv_show = r.json()
-            return tv_show['data']['imdbId']
+        imdb_id = tv_show['data']['imdbId'] if tv_show else None
+        if found is not None:
+            self.cache.store('series', tvdb_id, imdb_id,
+                             not_found_ttl=self.cache_ttl['not_found'])
+        return imdb_id
+
+    def _ensure_token(self):
+        if not self.token:
+            try:
+                self.token, self.token_expires = self.cache.get(
+                    'token', ttl=3600 * 24)
+            except KeyError:
+                pass
+        # Tokens are valid for 24 hours, renew them an hour before
+        if self.token and self.token_expires - 3600 > time.time():
+            return
+        if self.token and self.token_expires > time.time():
+            self._refresh_token()
         else:
-            return None
+            self._login()
 
-    def _refresh_token(self):
+    def _set_token(self, token):
+        self.token = token
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            self.token_expires = json.loads(
+                base64.urlsafe_b64decode(payload))['exp']
+        except (IndexError, ValueError, KeyError, TypeError):
+            self.token_expires = time.time() + 3600 * 24
+        self.cache.set('token', (self.token, self.token_expires))
+
+    def _login(self):
         data = {
             'apikey': self.api_key,
             'userkey': self.user_key,
@@ -37,32 +100,42 @@ class TheTVDB(object):
         }
 
         url = "https://api.thetvdb.com/login"
-        r = requests.post(url, json=data)
+        r = self.session.post(url, json=data)
 
         if r.status_code == 200:
             result = r.json()
-            self.token = result['token']
+            self._set_token(result['token'])
         else:
-            return None
+            self.token = None
+
+    def _refresh_token(self):
+        url = "https://api.thetvdb.com/refresh_token"
+        headers = {
+            'Authorization': 'Bearer {token}'.format(token=self.token)
+        }
+        r = self.session.get(url, headers=headers)
+
+        if r.status_code == 200:
+            result = r.json()
+            self._set_token(result['token'])
+        else:
+            self._login()
 
     def get_tvdb_from_imdb(self, imdb_id):
-        # TODO Cache
-        if not self.token:
-            self._refresh_token()
+        hit, item = self.cache.lookup('search', imdb_id,
+                                      ttl=self.cache_ttl['search'])
+        if hit:
+            return item
 
         params = {
             'imdbId': imdb_id
         }
 
         url = "https://api.thetvdb.com/search/series"
-        headers = {
-            'Authorization': 'Bearer {token}'.format(token=self.token)
-        }
-        r = requests.get(url, headers=headers, params=params)
-
-        if r.status_code == 200:
-            item = json.loads(r.text)
+        found, item = self._request(url, params=params)
 
-            return item.get('data')[0] if item and item.get('data') else None
-        else:
-            return None
+        item = item.get('data')[0] if item and item.get('data') else None
+        if found is not None:
+            self.cache.store('search', imdb_id, item,
+                             not_found_ttl=self.cache_ttl['not_found'])
+        return item
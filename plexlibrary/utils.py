@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+import threading
+import time
 from datetime import datetime
 
 import ruamel.yaml
@@ -47,6 +50,102 @@ class YAMLBase(object):
             yaml.dump(self.data, f)
 
 
+class PathIndex(object):
+    """Case-insensitive index of root folders, to find the root folder
+    that contains a path without scanning every root
+    """
+    def __init__(self, roots):
+        self._roots = {}
+        for root in roots:
+            root = os.path.abspath(root)
+            self._roots.setdefault(self._normalize(root), root)
+
+    @staticmethod
+    def _normalize(path):
+        return os.path.normcase(os.path.abspath(path)).lower()
+
+    def find(self, path):
+        """Returns the deepest root folder containing path, or None"""
+        path = self._normalize(path)
+        while True:
+            if path in self._roots:
+                return self._roots[path]
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter
+
+    Allows bursts of up to capacity requests, refilled at rate tokens per
+    second.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Empty the bucket so no requests are made for a while, e.g. on
+        a Retry-After response
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class ItemIds(object):
+    """Set of the ids of list items, kept per id namespace
+
+    An item is contained if any of its IMDb, TMDb or TVDB ids is.
+    """
+    def __init__(self, items=None):
+        self._ids = {
+            'imdb': set(),
+            'tmdb': set(),
+            'tvdb': set(),
+        }
+        for item in items or []:
+            self.add(item)
+
+    @staticmethod
+    def _get_ids(item):
+        return (('imdb', item.get('id')),
+                ('tmdb', item.get('tmdb_id')),
+                ('tvdb', item.get('tvdb_id')))
+
+    def __contains__(self, item):
+        for namespace, id_ in self._get_ids(item):
+            if id_ and str(id_) in self._ids[namespace]:
+                return True
+        return False
+
+    def add(self, item):
+        for namespace, id_ in self._get_ids(item):
+            if id_:
+                self._ids[namespace].add(str(id_))
+
+
 def add_years(years, from_date=None):
     if from_date is None:
         from_date = datetime.now()